@@ -1,4 +1,66 @@
-from .core import Rearrange
-def rearrange(tensor, pattern, **axes_lengths):
-    return Rearrange()(tensor, pattern, **axes_lengths)
-__all__ = ['rearrange']
\ No newline at end of file
+from . import instrument
+from .core import Rearrange, pattern_cache, plan_cache
+from .batching import Batch, BucketTiming
+from .cache import CacheInfo
+from .dispatch import autotune, load_profile
+from .parallel import get_workers, set_workers
+from .inference import Inference
+from .lazy import LazyRearrange
+from .plan import RearrangePlan
+from .pool import BufferPool, PoolInfo
+
+_default = Rearrange()
+_instances = {'numpy': _default}
+
+def _get_instance(backend):
+    if backend is None:
+        return _default
+    instance = _instances.get(backend)
+    if instance is None:
+        instance = _instances.setdefault(backend, Rearrange(backend=backend))
+    return instance
+
+def rearrange(tensor, pattern, backend=None, out=None, max_memory=None, workers=None, pool=None, copy=None,
+              inplace=False, **axes_lengths):
+    return _get_instance(backend)(tensor, pattern, out=out, max_memory=max_memory, workers=workers, pool=pool,
+                                  copy=copy, inplace=inplace, **axes_lengths)
+
+def reduce(tensor, pattern, reduction, backend=None, **axes_lengths):
+    return _get_instance(backend).reduce(tensor, pattern, reduction, **axes_lengths)
+
+def repeat(tensor, pattern, backend=None, copy=None, workers=None, **axes_lengths):
+    return _get_instance(backend).repeat(tensor, pattern, copy=copy, workers=workers, **axes_lengths)
+
+def infer(pattern, shapes, dtype='float64', **axes_lengths) -> Inference:
+    return _default.infer(pattern, shapes, dtype, **axes_lengths)
+
+def batch(arrays, pattern, backend=None, stack=None, **axes_lengths) -> Batch:
+    return _get_instance(backend).batch(arrays, pattern, stack=stack, **axes_lengths)
+
+def pack(tensors, pattern, workers=None):
+    return _default.pack(tensors, pattern, workers)
+
+def unpack(tensor, shapes, pattern):
+    return _default.unpack(tensor, shapes, pattern)
+
+def lazy(tensor, backend=None) -> LazyRearrange:
+    return LazyRearrange(_get_instance(backend), tensor)
+
+def warmup(patterns=(), dtypes=('float32',), backend=None) -> None:
+    _get_instance(backend).warmup(patterns, dtypes)
+
+def compile(pattern, backend=None, **axes_lengths) -> RearrangePlan:
+    return _get_instance(backend).compile(pattern, **axes_lengths)
+
+def cache_info() -> CacheInfo:
+    return plan_cache.info()
+
+def clear_cache() -> None:
+    plan_cache.clear()
+    pattern_cache.clear()
+
+def set_cache_size(maxsize: int) -> None:
+    plan_cache.resize(maxsize)
+    pattern_cache.resize(maxsize)
+
+__all__ = ['rearrange', 'reduce', 'repeat', 'infer', 'Inference', 'pack', 'unpack', 'batch', 'Batch', 'BucketTiming', 'compile', 'RearrangePlan', 'lazy', 'LazyRearrange', 'BufferPool', 'PoolInfo', 'instrument', 'set_workers', 'get_workers', 'autotune', 'load_profile', 'cache_info', 'clear_cache', 'set_cache_size', 'warmup']
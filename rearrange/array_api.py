@@ -0,0 +1,36 @@
+from functools import lru_cache
+from types import SimpleNamespace
+
+import numpy as np
+
+from .optimizer import IDENTITY
+
+
+@lru_cache(maxsize=None)
+def _torch_namespace() -> SimpleNamespace:
+    # torch tensors only expose the array API through array_api_compat; their own reshape and
+    # permute return views wherever the strides allow, and keep autograd history
+    return SimpleNamespace(reshape=lambda x, shape: x.reshape(shape), permute_dims=lambda x, axes: x.permute(axes))
+
+
+def array_namespace(tensor):
+    # The namespace used to rearrange a non-NumPy array with its own ops, or None for NumPy
+    # arrays and anything that is not an array
+    if isinstance(tensor, np.ndarray):
+        return None
+    get_namespace = getattr(tensor, '__array_namespace__', None)
+    if get_namespace is not None:
+        return get_namespace()
+    if type(tensor).__module__.split('.')[0] == 'torch':
+        return _torch_namespace()
+    return None
+
+
+def rearrange_array_api(xp, tensor, recipe):
+    # the NumPy plan run with the framework's reshape and permute_dims, so no data leaves it
+    if recipe.drop_index is not None:
+        tensor = tensor[recipe.drop_index]
+    if recipe.kind == IDENTITY:
+        return xp.reshape(tensor, recipe.final_shape)
+    tensor = xp.permute_dims(xp.reshape(tensor, recipe.reduced_shape), recipe.reduced_perm)
+    return xp.reshape(tensor, recipe.final_shape)
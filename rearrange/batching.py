@@ -0,0 +1,75 @@
+import time
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from . import instrument
+from .cache import axes_key
+from .optimizer import classify, coalesce_axes
+from .plan import recipe_strides
+
+# below this many bytes per array, stacking a bucket into one transpose beats one call per array
+STACK_MAX_BYTES = 1 << 14
+
+BucketTiming = namedtuple('BucketTiming', ['shape', 'dtype', 'count', 'stacked', 'plan_s', 'execute_s'])
+# `outputs` follow the order of the inputs, `buckets` the order each (shape, dtype) was first seen;
+# the outputs of a stacked bucket are slices of one shared result array
+Batch = namedtuple('Batch', ['outputs', 'buckets'])
+
+
+def stacked_recipe(recipe, count: int):
+    # `recipe` with a leading axis of `count` arrays that stays in front
+    from .core import Recipe
+    drop_index = None if recipe.drop_index is None else (slice(None),) + recipe.drop_index
+    inter = (count,) + recipe.intermediate_shape
+    perm = (0,) + tuple(p + 1 for p in recipe.perm)
+    reduced_shape, reduced_perm = coalesce_axes(inter, perm)
+    return Recipe(drop_index, inter, perm, (count,) + recipe.final_shape, recipe.axis_sizes, reduced_shape,
+                  reduced_perm, classify(reduced_perm))
+
+
+def rearrange_batch(planner, arrays, pattern: str, axes_lengths: Dict[str, int],
+                    stack: Optional[bool] = None) -> Batch:
+    # One plan per (shape, dtype) bucket. Buckets of small arrays that need a copy anyway are
+    # stacked and rearranged by a single transpose (stack=None); stack=True or False forces it.
+    start = time.perf_counter()
+    specs = planner.parse(pattern)
+    parse_s = time.perf_counter() - start
+    key = axes_key(axes_lengths)
+    buckets: Dict[tuple, List[int]] = {}
+    for k, array in enumerate(arrays):
+        buckets.setdefault((tuple(array.shape), np.dtype(array.dtype) if isinstance(array, np.ndarray)
+                            else array.dtype), []).append(k)
+    outputs = [None] * len(arrays)
+    timings = []
+    for (shape, dtype), members in buckets.items():
+        start = time.perf_counter()
+        recipe = planner.resolve(pattern, shape, dtype if isinstance(dtype, np.dtype) else None, axes_lengths,
+                                 key, specs)
+        planned = time.perf_counter()
+        first = arrays[members[0]]
+        stacked = len(members) > 1 and isinstance(first, np.ndarray) and stack is not False
+        if stacked and stack is None:
+            view = all(recipe_strides(recipe, shape, arrays[k].strides, first.itemsize) is not None for k in members)
+            stacked = not view and first.nbytes <= STACK_MAX_BYTES
+        if stacked:
+            stack_in = np.empty((len(members),) + shape, dtype=dtype)
+            for row, k in zip(stack_in, members):
+                np.copyto(row, arrays[k])
+            result = planner._execute(stack_in, stacked_recipe(recipe, len(members)))
+            for k, output in zip(members, result):
+                outputs[k] = output
+        else:
+            for k in members:
+                outputs[k] = planner._execute(arrays[k], recipe)
+        timing = BucketTiming(shape, dtype, len(members), stacked, planned - start, time.perf_counter() - planned)
+        timings.append(timing)
+        if instrument.enabled:
+            # one record per array, with the bucket's time shared evenly and the parse on the first
+            for k in members:
+                backend = planner.selected_backend(arrays[k], recipe) if isinstance(first, np.ndarray) else 'array_api'
+                instrument.observe(pattern, arrays[k], outputs[k], backend, parse_s, timing.plan_s / timing.count,
+                                   timing.execute_s / timing.count)
+                parse_s = 0.0
+    return Batch(outputs, timings)
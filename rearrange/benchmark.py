@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .core import Rearrange
+from .dispatch import BACKENDS, backend_available
+
+LAYOUTS = ('C', 'F', 'sliced')
+DEFAULT_SIZES = (100, 10_000, 1_000_000, 100_000_000)
+
+
+def _factor(n: int, k: int) -> List[int]:
+    side = max(int(round(n ** (1.0 / k))), 1)
+    dims = [side] * (k - 1)
+    dims.append(max(n // side ** (k - 1), 1))
+    return dims
+
+
+# family -> (pattern, shape for ~n elements, axes lengths)
+FAMILIES: Dict[str, Callable[[int], tuple]] = {
+    'split': lambda n: ('b (h w) c -> b h w c', (lambda d: (d[0], d[1] * 2, d[2]))(_factor(max(n // 2, 1), 3)),
+                        {'h': 2}),
+    'merge': lambda n: ('b h w c -> b (h w) c', tuple(_factor(n, 4)), {}),
+    'permute': lambda n: ('b h w c -> b c h w', tuple(_factor(n, 4)), {}),
+    'ellipsis': lambda n: ('... h w -> ... w h', tuple(_factor(n, 4)), {}),
+    'singleton': lambda n: ('b 1 h w -> w h b 1', (lambda d: (d[0], 1, d[1], d[2]))(_factor(n, 3)), {}),
+    'literal': lambda n: ('b h w 3 -> b 3 h w', tuple(_factor(max(n // 3, 1), 3)) + (3,), {}),
+}
+
+
+def make_input(shape: Sequence[int], layout: str, dtype) -> np.ndarray:
+    if layout == 'C':
+        return np.ones(shape, dtype=dtype)
+    if layout == 'F':
+        return np.asfortranarray(np.ones(shape, dtype=dtype))
+    if layout == 'sliced':
+        return np.ones((shape[0] * 2,) + tuple(shape[1:]), dtype=dtype)[::2]
+    raise ValueError(f"Unknown layout '{layout}', expected one of {LAYOUTS}")
+
+
+def raw_numpy(r: Rearrange, pattern: str, x: np.ndarray, axes: Dict[str, int]) -> Callable[[], np.ndarray]:
+    recipe = r.plan(pattern, x.shape, x.dtype, axes)
+
+    def run():
+        y = x if recipe.drop_index is None else x[recipe.drop_index]
+        return np.transpose(y.reshape(recipe.intermediate_shape), recipe.perm).reshape(recipe.final_shape)
+    return run
+
+
+def _loop(fn: Callable, number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return time.perf_counter() - start
+
+
+def time_call(fn: Callable, min_time: float = 0.05, repeat: int = 5) -> float:
+    fn()
+    number = 1
+    elapsed = _loop(fn, number)
+    while elapsed < min_time and number < 1 << 20:
+        number *= 10 if elapsed < min_time / 10 else 2
+        elapsed = _loop(fn, number)
+    return min([elapsed] + [_loop(fn, number) for _ in range(repeat - 1)]) / number
+
+
+def peak_memory(fn: Callable) -> int:
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(sizes: Sequence[int] = DEFAULT_SIZES, families: Sequence[str] = tuple(FAMILIES),
+        backends: Optional[Sequence[str]] = None, layouts: Sequence[str] = LAYOUTS, dtype=np.float32,
+        min_time: float = 0.05, repeat: int = 5, log: Optional[Callable[[str], None]] = None) -> dict:
+    dtype = np.dtype(dtype)
+    if backends is None:
+        backends = [name for name in BACKENDS if backend_available(name)] + ['auto']
+    runners = {name: Rearrange(backend=name) for name in backends}
+    results = []
+    for family in families:
+        for n in sizes:
+            pattern, shape, axes = FAMILIES[family](int(n))
+            for layout in layouts:
+                x = make_input(shape, layout, dtype)
+                candidates = [('raw_numpy', raw_numpy(runners.get('numpy', Rearrange()), pattern, x, axes))]
+                candidates += [(name, (lambda r=r: r(x, pattern, **axes))) for name, r in runners.items()]
+                for name, fn in candidates:
+                    latency = time_call(fn, min_time, repeat)
+                    view = bool(np.shares_memory(fn(), x))
+                    record = {
+                        'family': family, 'pattern': pattern, 'backend': name, 'layout': layout,
+                        'elements': int(x.size), 'shape': list(x.shape), 'dtype': dtype.str,
+                        'latency_s': latency, 'gb_per_s': 0.0 if view else 2 * x.nbytes / latency / 1e9,
+                        'peak_bytes': peak_memory(fn), 'view': view,
+                    }
+                    results.append(record)
+                    if log:
+                        log(f"{family:9s} {layout:6s} {x.size:>11d} {name:9s} {latency * 1e6:12.2f} us "
+                            f"{record['gb_per_s']:7.2f} GB/s {record['peak_bytes']:>12d} B")
+                del x
+    return {'meta': environment(), 'results': results}
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+        'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def _key(record: dict) -> tuple:
+    return record['family'], record['backend'], record['layout'], record['elements'], record['dtype']
+
+
+def compare(old: dict, new: dict, threshold: float = 1.1) -> List[dict]:
+    baseline = {_key(r): r for r in old['results']}
+    regressions = []
+    for record in new['results']:
+        before = baseline.get(_key(record))
+        if before is None or before['latency_s'] <= 0:
+            continue
+        ratio = record['latency_s'] / before['latency_s']
+        if ratio > threshold:
+            regressions.append({**record, 'previous_latency_s': before['latency_s'], 'ratio': ratio})
+    return regressions
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m rearrange.benchmark')
+    parser.add_argument('--sizes', type=float, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--families', nargs='+', default=list(FAMILIES), choices=list(FAMILIES))
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS) + ['auto'])
+    parser.add_argument('--layouts', nargs='+', default=list(LAYOUTS), choices=list(LAYOUTS))
+    parser.add_argument('--dtype', default='float32')
+    parser.add_argument('--min-time', type=float, default=0.05)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--out', help='write results as JSON to this path')
+    parser.add_argument('--compare', help='JSON results of a previous run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=1.1)
+    args = parser.parse_args(argv)
+
+    report = run([int(n) for n in args.sizes], args.families, args.backends, args.layouts, args.dtype,
+                 args.min_time, args.repeat, log=print)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['family']} {r['backend']} {r['layout']} {r['elements']}: "
+                  f"{r['previous_latency_s'] * 1e6:.2f} us -> {r['latency_s'] * 1e6:.2f} us ({r['ratio']:.2f}x)")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import math
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from . import parallel
+from .optimizer import classify, coalesce_axes
+from .plan import reshape_view
+
+
+def open_output(out, shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+    if isinstance(out, (str, os.PathLike)):
+        return np.lib.format.open_memmap(os.fspath(out), mode='w+', dtype=dtype, shape=shape)
+    if tuple(out.shape) != tuple(shape):
+        raise ValueError(f"Output shape mismatch: expected {tuple(shape)}, got {tuple(out.shape)}")
+    if out.dtype != dtype:
+        raise ValueError(f"Output dtype mismatch: expected {dtype}, got {out.dtype}")
+    if not out.flags.writeable:
+        raise ValueError("Output array is read-only")
+    return out
+
+
+def _group_start(prefix: int, shape: Tuple[int, ...]) -> Optional[int]:
+    # dimension of `shape` whose first split axis starts after `prefix` elements, if any
+    acc = 1
+    for d, size in enumerate(shape):
+        if acc == prefix and size != 1:
+            return d
+        acc *= size
+        if acc > prefix:
+            return None
+    return None
+
+
+def chunk_candidates(recipe, in_shape: Tuple[int, ...]) -> List[Tuple[int, int, int]]:
+    # Split axes that start a dimension in both the input and the output, so a range of
+    # them is a plain slice of both arrays: (axis, input dim, output dim).
+    inter = recipe.intermediate_shape
+    permuted = [inter[p] for p in recipe.perm]
+    candidates = []
+    for j, size in enumerate(inter):
+        if size <= 1:
+            continue
+        d_in = _group_start(math.prod(inter[:j]), in_shape)
+        k = recipe.perm.index(j)
+        d_out = _group_start(math.prod(permuted[:k]), recipe.final_shape)
+        if d_in is not None and d_out is not None:
+            candidates.append((j, d_in, d_out))
+    return candidates
+
+
+def choose_chunking(recipe, in_shape: Tuple[int, ...], itemsize: int, max_memory: Optional[int],
+                    buffers: int = 1) -> Optional[Tuple[int, int, int, int]]:
+    # `buffers` is how many tile-sized buffers are live at once while a tile is copied
+    total = math.prod(recipe.intermediate_shape) * itemsize * buffers
+    if max_memory is None or total <= max_memory:
+        return None
+    fitting = []
+    for j, d_in, d_out in chunk_candidates(recipe, in_shape):
+        slice_bytes = total // recipe.intermediate_shape[j]
+        if slice_bytes <= max_memory:
+            fitting.append(((d_in + d_out, -recipe.intermediate_shape[j]), j, d_in, d_out, slice_bytes))
+    if not fitting:
+        raise ValueError(f"max_memory={max_memory} bytes is too small to chunk this rearrange "
+                         f"({total} bytes, no axis can be sliced in both input and output)")
+    _, j, d_in, d_out, slice_bytes = min(fitting)
+    return j, d_in, d_out, max(1, max_memory // slice_bytes)
+
+
+def _copy_tile(planner, src: np.ndarray, dst: np.ndarray, recipe, inter: Tuple[int, ...],
+               use_numpy: bool, workers: Optional[int]) -> None:
+    permuted = tuple(inter[p] for p in recipe.perm)
+    target = reshape_view(dst, permuted) if use_numpy else None
+    if target is not None:
+        # both reshapes only split dimensions, so the tile is copied once without a temporary
+        parallel.copyto(target, np.transpose(src.reshape(inter), recipe.perm), workers)
+        return
+    reduced_shape, reduced_perm = coalesce_axes(inter, recipe.perm)
+    tile = recipe._replace(drop_index=None, intermediate_shape=inter, final_shape=dst.shape,
+                           reduced_shape=reduced_shape, reduced_perm=reduced_perm, kind=classify(reduced_perm))
+    result = planner._execute(src, tile, dst)
+    if result is not dst:
+        parallel.copyto(dst, result, workers)
+
+
+def rearrange_chunked(planner, tensor: np.ndarray, recipe, out=None, max_memory: Optional[int] = None,
+                      workers: Optional[int] = None) -> np.ndarray:
+    if max_memory is not None and max_memory <= 0:
+        raise ValueError(f"max_memory must be positive, got {max_memory}")
+    if out is None:
+        out = np.empty(recipe.final_shape, dtype=tensor.dtype)
+    else:
+        out = open_output(out, recipe.final_shape, tensor.dtype)
+    if recipe.drop_index is not None:
+        tensor = tensor[recipe.drop_index]
+    if tensor.size == 0:
+        return out
+    use_numpy = planner.selected_backend(tensor, recipe) == 'numpy'
+    buffers = 1 if use_numpy else 2
+    chunking = choose_chunking(recipe, tensor.shape, tensor.itemsize, max_memory, buffers)
+    if chunking is None:
+        _copy_tile(planner, tensor, out, recipe, recipe.intermediate_shape, use_numpy, workers)
+    else:
+        j, d_in, d_out, step = chunking
+        size = recipe.intermediate_shape[j]
+        in_inner = tensor.shape[d_in] // size
+        out_inner = recipe.final_shape[d_out] // size
+        for start in range(0, size, step):
+            stop = min(start + step, size)
+            inter = recipe.intermediate_shape[:j] + (stop - start,) + recipe.intermediate_shape[j + 1:]
+            src = tensor[(slice(None),) * d_in + (slice(start * in_inner, stop * in_inner),)]
+            dst = out[(slice(None),) * d_out + (slice(start * out_inner, stop * out_inner),)]
+            _copy_tile(planner, src, dst, recipe, inter, use_numpy, workers)
+            if isinstance(out, np.memmap):
+                out.flush()
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
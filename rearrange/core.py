@@ -1,12 +1,44 @@
+import importlib.util
+import math
+import time
 import numpy as np
-from typing import Dict, List, Tuple, Union
-from .parser import PatternParser, ParserError
+from collections import namedtuple
+from typing import Callable, Dict, List, Tuple, Union
+from . import dispatch, instrument, packing, parallel
+from .array_api import array_namespace, rearrange_array_api
+from .batching import Batch, rearrange_batch
+from .cache import PlanCache, axes_key
+from .chunked import rearrange_chunked
+from .inference import Inference, infer_shapes
+from .inplace import check_inplace_pattern, rearrange_inplace
+from .parser import PatternParser, as_value_error
+from .optimizer import IDENTITY, classify, coalesce_axes, coalesce_strided
+from .reduction import check_reduction, numba_reducible, reduce_numpy
+from .plan import RearrangePlan, recipe_strides, reshape_strides, reshape_view, strided_view, unmergeable_group
+
+Recipe = namedtuple('Recipe', ['drop_index', 'intermediate_shape', 'perm', 'final_shape', 'axis_sizes',
+                               'reduced_shape', 'reduced_perm', 'kind', 'reduced_axes'], defaults=((),))
+
+# `base` rearranges the input into the output order of its own axes, one dimension per axis;
+# the output-only axes are inserted at `new_axes` of `expanded_shape` with a zero stride
+RepeatRecipe = namedtuple('RepeatRecipe', ['base', 'expanded_shape', 'new_axes', 'final_shape'])
+
+pattern_cache = PlanCache(maxsize=128)
+plan_cache = PlanCache(maxsize=1024)
 
 class Rearrange:
-    def __init__(self, use_numba=False, use_eigen=False):
+    def __init__(self, use_numba=False, use_eigen=False, backend: str = None):
         self.parser = PatternParser()
-        self.use_numba = use_numba and numba_available
-        self.use_eigen = use_eigen and eigen_available
+        if backend is None:
+            backend = 'numba' if use_numba else 'eigen' if use_eigen else 'numpy'
+        if backend not in dispatch.BACKENDS + ('auto',):
+            raise ValueError(f"Unknown backend '{backend}', expected one of {dispatch.BACKENDS + ('auto',)}")
+        if backend != 'auto' and not dispatch.backend_available(backend):
+            backend = 'numpy'
+        self.backend_name = backend
+        self.use_numba = backend == 'numba'
+        self.use_eigen = backend == 'eigen'
+        self.transpose = None if backend == 'auto' else dispatch.get_transpose(backend)
         if self.use_numba:
             from .numba_backend import rearrange_numba
             self.backend = rearrange_numba
@@ -16,16 +48,317 @@ class Rearrange:
         else:
             self.backend = self._numpy_backend
 
-    def __call__(self, tensor: np.ndarray, pattern: str, **axes_lengths: int) -> np.ndarray:
+    def __call__(self, tensor: np.ndarray, pattern: str, out=None, max_memory: int = None,
+                 workers: int = None, pool=None, copy: bool = None, inplace: bool = False,
+                 **axes_lengths: int) -> np.ndarray:
+        try:
+            foreign = not isinstance(tensor, np.ndarray) and array_namespace(tensor) is not None
+            if foreign and (out is not None or pool is not None or max_memory is not None or copy is not None
+                            or inplace):
+                raise ValueError("out=, pool=, max_memory=, copy= and inplace= need a NumPy array, got "
+                                 f"{type(tensor).__module__}.{type(tensor).__name__}")
+            if inplace:
+                check_inplace_pattern(self.parser, *self.parse(pattern))
+            dtype = None if foreign else tensor.dtype
+            if instrument.enabled:
+                return self._call_instrumented(
+                    tensor, pattern, lambda: self.plan(pattern, tuple(tensor.shape), dtype, axes_lengths),
+                    lambda recipe: self._run(tensor, pattern, recipe, out, pool, max_memory, workers, copy, inplace),
+                    lambda recipe: 'array_api' if foreign else self.selected_backend(tensor, recipe),
+                    allocated=out is None)
+            recipe = self.plan(pattern, tuple(tensor.shape), dtype, axes_lengths)
+            return self._run(tensor, pattern, recipe, out, pool, max_memory, workers, copy, inplace)
+        except Exception as e:
+            raise as_value_error(e)
+
+    def _run(self, tensor: np.ndarray, pattern: str, recipe: Recipe, out, pool, max_memory: int,
+             workers: int, copy: bool, inplace: bool) -> np.ndarray:
+        if out is not None or pool is not None or max_memory is not None or copy is not None or inplace:
+            output_spec = self.parse(pattern)[1] if copy is False else None
+            return self._execute_into(tensor, recipe, out, pool, max_memory, workers, copy, output_spec, inplace)
+        if (workers or parallel.get_workers()) > 1 and isinstance(tensor, np.ndarray) \
+                and self._parallel_worthwhile(tensor, recipe):
+            return rearrange_chunked(self, tensor, recipe, None, None, workers)
+        return self._execute(tensor, recipe)
+
+    def warmup(self, patterns=(), dtypes=(np.float32,)) -> None:
+        # Patterns are strings, only parsed, or (pattern, shape[, axes_lengths]) tuples that are run
+        # once per dtype on zeros so their plans are cached too.
+        dtypes = [np.dtype(dtype) for dtype in dtypes]
+        if self.backend_name in ('numba', 'auto') and numba_available:
+            from .numba_backend import precompile
+            precompile(dtypes)
+        if self.backend_name in ('eigen', 'auto') and eigen_available:
+            # loading the extension is the warmup; nothing from it is called here
+            importlib.import_module(f'{__package__}.eigen_backend_wrapper')
+        for entry in patterns:
+            if isinstance(entry, str):
+                try:
+                    self.parse(entry)
+                except Exception as e:
+                    raise as_value_error(e)
+                continue
+            pattern, shape, *rest = entry
+            for dtype in dtypes:
+                self(np.zeros(shape, dtype=dtype), pattern, **(rest[0] if rest else {}))
+
+    def reduce(self, tensor: np.ndarray, pattern: str, reduction: str, **axes_lengths: int) -> np.ndarray:
+        try:
+            check_reduction(reduction)
+            if instrument.enabled:
+                return self._call_instrumented(
+                    tensor, pattern, lambda: self.plan_reduce(pattern, tensor.shape, tensor.dtype, axes_lengths),
+                    lambda recipe: self._reduce(tensor, recipe, reduction),
+                    lambda recipe: self._reduce_backend(
+                        tensor if recipe.drop_index is None else tensor[recipe.drop_index], recipe))
+            return self._reduce(tensor, self.plan_reduce(pattern, tensor.shape, tensor.dtype, axes_lengths),
+                                reduction)
+        except Exception as e:
+            raise as_value_error(e)
+
+    def _reduce(self, tensor: np.ndarray, recipe: Recipe, reduction: str) -> np.ndarray:
+        if recipe.drop_index is not None:
+            tensor = tensor[recipe.drop_index]
+        if self._reduce_backend(tensor, recipe) == 'numba':
+            from .numba_backend import reduce_numba
+            return reduce_numba(tensor, recipe, reduction)
+        return reduce_numpy(tensor, recipe, reduction)
+
+    def plan_reduce(self, pattern: str, shape: tuple, dtype, axes_lengths: Dict[str, int]) -> Recipe:
+        key = ('reduce', pattern, tuple(shape), np.dtype(dtype), axes_key(axes_lengths))
+        recipe = plan_cache.get(key)
+        if recipe is None:
+            input_spec, output_spec = self.parse(pattern)
+            recipe = self._build_recipe(tuple(shape), input_spec, output_spec, axes_lengths, reduce=True)
+            plan_cache.put(key, recipe)
+        return recipe
+
+    def _reduce_backend(self, tensor: np.ndarray, recipe: Recipe) -> str:
+        if self.backend_name not in ('numba', 'auto') or not numba_available:
+            return 'numpy'
+        if not numba_reducible(tensor.dtype) or tensor.size == 0 or not recipe.reduced_axes \
+                or 0 in recipe.final_shape:
+            return 'numpy'
+        if self.backend_name == 'auto':
+            return dispatch.select_reduce_backend(tensor.nbytes)
+        return 'numba'
+
+    def repeat(self, tensor: np.ndarray, pattern: str, copy: bool = None, workers: int = None,
+               **axes_lengths: int) -> np.ndarray:
+        try:
+            if instrument.enabled:
+                return self._call_instrumented(
+                    tensor, pattern, lambda: self.plan_repeat(pattern, tensor.shape, axes_lengths),
+                    lambda recipe: self._repeat(tensor, pattern, recipe, copy, workers), lambda recipe: 'numpy')
+            return self._repeat(tensor, pattern, self.plan_repeat(pattern, tensor.shape, axes_lengths), copy, workers)
+        except Exception as e:
+            raise as_value_error(e)
+
+    def _repeat(self, tensor: np.ndarray, pattern: str, recipe: RepeatRecipe, copy: bool,
+                workers: int) -> np.ndarray:
+        strides = list(recipe_strides(recipe.base, tensor.shape, tensor.strides, tensor.itemsize))
+        for pos in recipe.new_axes:
+            strides.insert(pos, 0)
+        final = reshape_strides(recipe.expanded_shape, strides, recipe.final_shape, tensor.itemsize)
+        if final is not None and not copy:
+            # read-only like np.broadcast_to: every repeated element aliases the same memory
+            return np.lib.stride_tricks.as_strided(tensor, recipe.final_shape, final, writeable=False)
+        if copy is False:
+            label = unmergeable_group(list(zip(recipe.expanded_shape, strides)), recipe.final_shape,
+                                      self.parse(pattern)[1])
+            raise ValueError(f"Cannot repeat without a copy: output group {label} mixes repeated and "
+                             f"input axes that cannot share one stride")
+        expanded = np.lib.stride_tricks.as_strided(tensor, recipe.expanded_shape, strides, writeable=False)
+        out = np.empty(recipe.final_shape, dtype=tensor.dtype)
+        parallel.copyto(reshape_view(out, recipe.expanded_shape), expanded, workers)
+        return out
+
+    def plan_repeat(self, pattern: str, shape: tuple, axes_lengths: Dict[str, int]) -> RepeatRecipe:
+        key = ('repeat', pattern, tuple(shape), axes_key(axes_lengths))
+        recipe = plan_cache.get(key)
+        if recipe is None:
+            input_spec, output_spec = self.parse(pattern)
+            input_axes = self.parser.get_axes(input_spec)
+            base_spec, layout = [], []
+            for token in output_spec:
+                members = []
+                for ax in (token if isinstance(token, tuple) else (token,)):
+                    if ax in ('...', '1') or ax in input_axes:
+                        base_spec.append(ax)
+                        members.append(ax)
+                    elif ax in axes_lengths:
+                        members.append(int(axes_lengths[ax]))
+                    elif ax.isdigit():
+                        members.append(int(ax))
+                    else:
+                        raise ValueError(f"Output axis '{ax}' not in input and not specified")
+                layout.append((isinstance(token, tuple), members))
+            base = self._build_recipe(tuple(shape), input_spec, base_spec, axes_lengths)
+            sizes = iter(base.final_shape)
+            ellipsis_dims = len(base.final_shape) - len(base_spec) + 1
+            expanded_shape, new_axes, final_shape = [], [], []
+            for grouped, members in layout:
+                group = []
+                for ax in members:
+                    if isinstance(ax, int):
+                        new_axes.append(len(expanded_shape) + len(group))
+                        group.append(ax)
+                    elif ax == '...':
+                        dims = [next(sizes) for _ in range(ellipsis_dims)]
+                        final_shape.extend(dims)
+                        expanded_shape.extend(dims)
+                    else:
+                        group.append(next(sizes))
+                if grouped or group:
+                    final_shape.append(math.prod(group))
+                    expanded_shape.extend(group)
+            recipe = RepeatRecipe(base, tuple(expanded_shape), tuple(new_axes), tuple(final_shape))
+            plan_cache.put(key, recipe)
+        return recipe
+
+    def _execute_into(self, tensor: np.ndarray, recipe: Recipe, out=None, pool=None, max_memory: int = None,
+                      workers: int = None, copy: bool = None, output_spec: list = None,
+                      inplace: bool = False) -> np.ndarray:
+        if inplace:
+            if out is not None or pool is not None or max_memory is not None or copy is not None:
+                raise ValueError("inplace=True reuses the input buffer and cannot be combined with "
+                                 "out=, pool=, max_memory= or copy=")
+            return rearrange_inplace(tensor, recipe)
+        if copy is False:
+            if out is not None or pool is not None:
+                raise ValueError("copy=False returns a view and cannot be combined with out= or pool=")
+            return strided_view(tensor, recipe, output_spec)
+        if out is None:
+            view = recipe_strides(recipe, tensor.shape, tensor.strides, tensor.itemsize) is not None
+            if view and not copy and max_memory is None:
+                # a view needs no buffer, and BufferPool.release ignores it
+                return self._execute(tensor, recipe)
+            if pool is not None:
+                out = pool.lease(recipe.final_shape, tensor.dtype)
+            elif not view and max_memory is None:
+                return self._execute(tensor, recipe)
+        return rearrange_chunked(self, tensor, recipe, out, max_memory, workers)
+
+    def _call_instrumented(self, tensor: np.ndarray, pattern: str, plan: Callable[[], Recipe],
+                           run: Callable[[Recipe], np.ndarray], backend: Callable[[Recipe], str],
+                           allocated: bool = True) -> np.ndarray:
+        start = time.perf_counter()
+        self.parse(pattern)
+        parsed = time.perf_counter()
+        recipe = plan()
+        planned = time.perf_counter()
+        result = run(recipe)
+        done = time.perf_counter()
+        instrument.observe(pattern, tensor, result, backend(recipe), parsed - start, planned - parsed,
+                           done - planned, allocated)
+        return result
+
+    def _parallel_worthwhile(self, tensor: np.ndarray, recipe: Recipe) -> bool:
+        if recipe.kind == IDENTITY or tensor.nbytes < parallel.PARALLEL_MIN_BYTES:
+            return False
+        if self.selected_backend(tensor, recipe) != 'numpy':
+            return False
+        # results that come out as views need no copy at all
+        return recipe_strides(recipe, tensor.shape, tensor.strides, tensor.itemsize) is None
+
+    def selected_backend(self, tensor: np.ndarray, recipe: Recipe) -> str:
+        return self.backend_for(recipe, tensor.shape, tensor.strides, tensor.dtype)
+
+    def backend_for(self, recipe: Recipe, shape: tuple, strides: tuple, dtype) -> str:
+        if self.backend_name != 'auto':
+            return self.backend_name
+        if recipe.kind == IDENTITY:
+            return 'numpy'
+        dtype = np.dtype(dtype)
+        view = recipe_strides(recipe, shape, strides, dtype.itemsize) is not None
+        return dispatch.select_backend(recipe, dtype, view)
+
+    def compile(self, pattern: str, **axes_lengths: int) -> RearrangePlan:
         try:
-            input_spec, output_spec = self.parser.parse(pattern)
-            return self.backend(tensor, input_spec, output_spec, axes_lengths)
-        except ParserError as e:
-            raise ValueError(f"Pattern parsing error: {str(e)}")
+            input_spec, output_spec = self.parse(pattern)
         except Exception as e:
-            if "Repeated dimension name" in str(e):
-                raise ValueError("Repeated dimension name")
-            raise ValueError(str(e))
+            raise as_value_error(e)
+        return RearrangePlan(self, pattern, input_spec, output_spec, axes_lengths)
+
+    def infer(self, pattern: str, shapes, dtype=np.float64, **axes_lengths: int) -> Inference:
+        # output shapes of one shape or of every row of an (N, ndim) array, without touching data
+        try:
+            input_spec, output_spec = self.parse(pattern)
+        except Exception as e:
+            raise as_value_error(e)
+        shapes = np.asarray(shapes, dtype=np.int64)
+        if shapes.ndim not in (1, 2):
+            raise ValueError(f"Expected one shape or an (N, ndim) array of shapes, got {shapes.ndim} dimensions")
+        result = infer_shapes(self, input_spec, output_spec, np.atleast_2d(shapes), np.dtype(dtype).itemsize,
+                              axes_lengths)
+        if shapes.ndim == 1:
+            return Inference(tuple(int(s) for s in result.shape[0]), int(result.nbytes[0]), bool(result.view[0]),
+                             int(result.error[0]))
+        return result
+
+    def batch(self, arrays, pattern: str, stack: bool = None, **axes_lengths: int) -> Batch:
+        try:
+            return rearrange_batch(self, arrays, pattern, axes_lengths, stack)
+        except Exception as e:
+            raise as_value_error(e)
+
+    def pack(self, tensors, pattern: str, workers: int = None) -> Tuple[np.ndarray, List[Tuple[int, ...]]]:
+        if not instrument.enabled:
+            return packing.pack(tensors, *self._parse_pack(pattern), workers)
+        tensors = [np.asarray(t) for t in tensors]
+        start = time.perf_counter()
+        layout = self._parse_pack(pattern)
+        parsed = time.perf_counter()
+        out, shapes = packing.pack(tensors, *layout, workers)
+        instrument.observe(pattern, tensors, out, 'numpy', parsed - start, 0.0, time.perf_counter() - parsed)
+        return out, shapes
+
+    def unpack(self, tensor: np.ndarray, shapes, pattern: str) -> List[np.ndarray]:
+        if not instrument.enabled:
+            return packing.unpack(tensor, shapes, *self._parse_pack(pattern))
+        start = time.perf_counter()
+        layout = self._parse_pack(pattern)
+        parsed = time.perf_counter()
+        views = packing.unpack(tensor, shapes, *layout)
+        instrument.observe(pattern, tensor, views, 'numpy', parsed - start, 0.0, time.perf_counter() - parsed)
+        return views
+
+    def _parse_pack(self, pattern: str) -> Tuple[int, int]:
+        key = ('pack', pattern)
+        layout = pattern_cache.get(key)
+        if layout is None:
+            try:
+                layout = packing.parse_pack(self.parser, pattern)
+            except Exception as e:
+                raise as_value_error(e)
+            pattern_cache.put(key, layout)
+        return layout
+
+    def parse(self, pattern: str) -> Tuple[list, list]:
+        specs = pattern_cache.get(pattern)
+        if specs is None:
+            specs = self.parser.parse(pattern)
+            pattern_cache.put(pattern, specs)
+        return specs
+
+    def plan(self, pattern: str, shape: tuple, dtype, axes_lengths: Dict[str, int]) -> Recipe:
+        return self.resolve(pattern, tuple(shape), dtype, axes_lengths, axes_key(axes_lengths))
+
+    def resolve(self, pattern: str, shape: tuple, dtype, axes_lengths: Dict[str, int],
+                axes_key: tuple, specs: Tuple[list, list] = None) -> Recipe:
+        key = (pattern, shape, None if dtype is None else np.dtype(dtype), axes_key)
+        recipe = plan_cache.get(key)
+        if recipe is None:
+            input_spec, output_spec = specs if specs is not None else self.parse(pattern)
+            recipe = self._build_recipe(shape, input_spec, output_spec, axes_lengths)
+            plan_cache.put(key, recipe)
+        return recipe
+
+    def execute(self, tensor: np.ndarray, recipe: Recipe) -> np.ndarray:
+        try:
+            return self._execute(tensor, recipe)
+        except Exception as e:
+            raise as_value_error(e)
 
     @staticmethod
     def _effective_tokens(tokens: List[Union[str, Tuple[str, ...]]], output_spec: List[Union[str, Tuple[str, ...]]]) -> int:
@@ -41,17 +374,57 @@ class Rearrange:
 
     def _numpy_backend(self, tensor: np.ndarray, input_spec: list, output_spec: list,
                        axes_lengths: Dict[str, int]) -> np.ndarray:
-        axis_sizes = self._determine_axis_sizes(tensor.shape, input_spec, output_spec, axes_lengths)
-        
+        recipe = self._build_recipe(tensor.shape, input_spec, output_spec, axes_lengths)
+        return self._execute(tensor, recipe)
+
+    def _execute(self, tensor: np.ndarray, recipe: Recipe, out: np.ndarray = None) -> np.ndarray:
+        # `out` is a hint for the compiled kernels: when it is returned, it holds the result
+        if not isinstance(tensor, np.ndarray):
+            xp = array_namespace(tensor)
+            if xp is not None:
+                return rearrange_array_api(xp, tensor, recipe)
+        transpose = self.transpose
+        if transpose is None and recipe.kind != IDENTITY:
+            transpose = dispatch.get_transpose(self.selected_backend(tensor, recipe))
+        if recipe.drop_index is not None:
+            tensor = tensor[recipe.drop_index]
+        if recipe.kind == IDENTITY:
+            return tensor.reshape(recipe.final_shape)
+        if not tensor.flags.c_contiguous:
+            # merging axes of a strided input could force an extra copy before the transpose
+            tensor = tensor.reshape(recipe.intermediate_shape)
+            if transpose is np.transpose:
+                return np.transpose(tensor, recipe.perm).reshape(recipe.final_shape)
+            # the compiled kernels gather from the strides directly; merge only what memory allows
+            shape, strides, perm = coalesce_strided(tensor.shape, tensor.strides, recipe.perm)
+            tensor = np.lib.stride_tricks.as_strided(tensor, shape, strides, writeable=False)
+        else:
+            tensor = tensor.reshape(recipe.reduced_shape)
+            perm = recipe.reduced_perm
+        if out is not None and transpose is not np.transpose:
+            target = reshape_view(out, tuple(tensor.shape[p] for p in perm))
+            if target is not None and target.flags.c_contiguous:
+                transpose(tensor, perm, out=target)
+                return out
+        return transpose(tensor, perm).reshape(recipe.final_shape)
+
+    def _build_recipe(self, shape: tuple, input_spec: list, output_spec: list,
+                      axes_lengths: Dict[str, int], reduce: bool = False) -> Recipe:
+        # with reduce=True, input axes missing from the output (literals included) are kept at the
+        # end of `perm` and listed in `reduced_axes` instead of raising
+        axis_sizes = self._determine_axis_sizes(shape, input_spec, output_spec, axes_lengths, reduce)
+        kept_literals = input_spec if reduce else output_spec
+
         pos = 0
         intermediate_shape = []
         input_axis_order = []
-        shp = tensor.shape  
+        shp = tuple(shape)
+        dropped = []
 
         for i, token in enumerate(input_spec):
             if token == '...':
-                remaining = self._effective_tokens(input_spec[i+1:], output_spec)
-                ellipsis_dims = tensor.ndim - pos - remaining
+                remaining = self._effective_tokens(input_spec[i+1:], kept_literals)
+                ellipsis_dims = len(shp) - pos - remaining
                 if ellipsis_dims < 0:
                     raise ValueError("Not enough axes for ellipsis")
                 for j in range(ellipsis_dims):
@@ -88,9 +461,9 @@ class Rearrange:
                 size = shp[pos]
                 if int(token) != size:
                     raise ValueError(f"Literal dimension mismatch: expected {token}, got {size}")
-                if token not in output_spec:
-                    tensor = np.take(tensor, 0, axis=pos)
-                    shp = tensor.shape
+                if token not in kept_literals:
+                    dropped.append(pos + len(dropped))
+                    shp = shp[:pos] + shp[pos+1:]
                 else:
                     intermediate_shape.append(size)
                     input_axis_order.append(token)
@@ -102,9 +475,11 @@ class Rearrange:
                 input_axis_order.append(token)
                 pos += 1
 
-        if pos != tensor.ndim:
+        if pos != len(shp):
             raise ValueError("Mismatch between consumed axes and tensor dimensions")
-        tensor = tensor.reshape(intermediate_shape)
+        if int(np.prod(intermediate_shape)) != int(np.prod(shp)):
+            raise ValueError(f"cannot reshape array of size {int(np.prod(shp))} "
+                             f"into shape {tuple(intermediate_shape)}")
 
         output_axis_order = []
         final_shape = []
@@ -127,29 +502,41 @@ class Rearrange:
 
         perm = [input_axis_order.index(ax) for ax in output_axis_order if ax in input_axis_order]
         new_order = perm + [i for i in range(len(input_axis_order)) if i not in perm]
-        try:
-            tensor = np.transpose(tensor, new_order)
-        except Exception as e:
-            if "axes don't match array" in str(e):
-                raise ValueError("Repeated dimension name")
-            raise ValueError(str(e))
+        if len(new_order) != len(input_axis_order):
+            raise ValueError("Repeated dimension name")
+        if len(set(new_order)) != len(new_order):
+            raise ValueError("repeated axis in transpose")
         kept_ndim = len(perm)
-        new_shape = tensor.shape[:kept_ndim]
-        tensor = tensor.reshape(new_shape)
-        total_size = np.prod(new_shape)
-        expected_size = np.prod(final_shape)
+        dropped_size = int(np.prod([intermediate_shape[i] for i in new_order[kept_ndim:]]))
+        if dropped_size != 1 and not reduce:
+            raise ValueError(f"cannot reshape array of size {int(np.prod(intermediate_shape))} "
+                             f"into shape {tuple(intermediate_shape[i] for i in perm)}")
+        total_size = int(np.prod([intermediate_shape[i] for i in perm]))
+        expected_size = int(np.prod(final_shape))
         if total_size != expected_size:
             raise ValueError(f"Shape mismatch: total size {total_size} != expected {expected_size}")
-        return tensor.reshape(final_shape)
+
+        drop_index = None
+        if dropped:
+            index = [slice(None)] * len(shape)
+            for axis in dropped:
+                index[axis] = 0
+            drop_index = tuple(index)
+        intermediate_shape = tuple(int(s) for s in intermediate_shape)
+        reduced_shape, reduced_perm = coalesce_axes(intermediate_shape, new_order)
+        return Recipe(drop_index, intermediate_shape, tuple(new_order), tuple(int(s) for s in final_shape),
+                      axis_sizes, reduced_shape, reduced_perm, classify(reduced_perm),
+                      tuple(new_order[kept_ndim:]) if reduce else ())
 
     def _determine_axis_sizes(self, shape: tuple, input_spec: list, output_spec: list,
-                                axes_lengths: Dict[str, int]) -> Dict[str, int]:
+                                axes_lengths: Dict[str, int], reduce: bool = False) -> Dict[str, int]:
+        kept_literals = input_spec if reduce else output_spec
         axis_sizes = axes_lengths.copy()
         pos = 0
         shp = shape
         for token in input_spec:
             if token == '...':
-                remaining = self._effective_tokens(input_spec[input_spec.index(token)+1:], output_spec)
+                remaining = self._effective_tokens(input_spec[input_spec.index(token)+1:], kept_literals)
                 ellipsis_dims = len(shp) - pos - remaining
                 if ellipsis_dims < 0:
                     raise ValueError("Not enough axes for ellipsis")
@@ -180,7 +567,7 @@ class Rearrange:
                 size = shp[pos]
                 if int(token) != size:
                     raise ValueError(f"Literal dimension mismatch: expected {token}, got {size}")
-                if token in output_spec:
+                if token in kept_literals:
                     axis_sizes[token] = size
                 pos += 1
             else:
@@ -198,14 +585,7 @@ class Rearrange:
                 axis_sizes[ax] = 1
         return axis_sizes
 
-try:
-    import numba
-    numba_available = True
-except ImportError:
-    numba_available = False
-
-try:
-    from .eigen_backend import rearrange_eigen
-    eigen_available = True
-except ImportError:
-    eigen_available = False
+# only look the backends up: importing numba alone takes a good part of a second, so the
+# backend modules are imported on first use
+numba_available = importlib.util.find_spec('numba') is not None
+eigen_available = importlib.util.find_spec(f'{__package__}.eigen_backend') is not None
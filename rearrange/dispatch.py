@@ -0,0 +1,204 @@
+import json
+import math
+import os
+import threading
+import time
+from bisect import bisect_right
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .optimizer import IDENTITY, TRANSPOSE_2D
+from .plan import movable
+
+BACKENDS = ('numpy', 'numba', 'eigen')
+PROFILE_VERSION = 1
+PROFILE_ENV = 'REARRANGE_PROFILE'
+DEFAULT_PROFILE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'rearrange', 'autotune.json')
+
+# Breakpoints per transpose class: from `min_bytes` upwards, try backends in the listed order.
+DEFAULT_PROFILE = {
+    'version': PROFILE_VERSION,
+    'breakpoints': {
+        TRANSPOSE_2D: [[0, ['numpy']], [1 << 18, ['numba', 'eigen', 'numpy']]],
+        'general': [[0, ['numpy']], [1 << 18, ['numba', 'eigen', 'numpy']]],
+        'high_rank': [[0, ['numpy']], [1 << 18, ['numba', 'numpy']]],
+        # reductions leave NumPy only from a crossover that autotune() measured
+        'reduce': [[0, ['numpy']]],
+    },
+}
+
+_profile = None
+_breakpoints = None
+_profile_lock = threading.Lock()
+
+
+def transpose_class(perm: Sequence[int]) -> str:
+    if len(perm) == 2:
+        return TRANSPOSE_2D
+    return 'general' if len(perm) <= 4 else 'high_rank'
+
+
+def backend_available(name: str) -> bool:
+    from . import core
+    if name == 'numba':
+        return core.numba_available
+    if name == 'eigen':
+        return core.eigen_available
+    return name == 'numpy'
+
+
+def supports(name: str, dtype: np.dtype, rank: int) -> bool:
+    if name == 'numpy':
+        return True
+    if not backend_available(name):
+        return False
+    if name == 'numba':
+        return movable(dtype)
+    from .eigen_backend_wrapper import max_rank
+    return movable(dtype) and rank <= max_rank
+
+
+def get_transpose(name: str) -> Callable:
+    if name == 'numpy':
+        return np.transpose
+    if name == 'numba':
+        from .numba_backend import transpose_numba
+        return transpose_numba
+    if name == 'eigen':
+        from .eigen_backend_wrapper import transpose_eigen
+        return transpose_eigen
+    raise ValueError(f"Unknown backend '{name}', expected one of {BACKENDS + ('auto',)}")
+
+
+def load_profile(path: Optional[str] = None) -> dict:
+    global _profile, _breakpoints
+    path = path or os.environ.get(PROFILE_ENV) or DEFAULT_PROFILE_PATH
+    profile = DEFAULT_PROFILE
+    if os.path.exists(path):
+        with open(path) as f:
+            loaded = json.load(f)
+        if loaded.get('version') == PROFILE_VERSION:
+            profile = loaded
+    breakpoints = {cls: ([b[0] for b in points], [b[1] for b in points])
+                   for cls, points in profile['breakpoints'].items()}
+    with _profile_lock:
+        _profile = profile
+        _breakpoints = breakpoints
+    return profile
+
+
+def current_profile() -> dict:
+    if _profile is None:
+        load_profile()
+    return _profile
+
+
+def select_backend(recipe, dtype: np.dtype, view: bool = False) -> str:
+    if recipe.kind == IDENTITY or view:
+        # numpy returns these as views of the input, every compiled kernel would copy
+        return 'numpy'
+    if _breakpoints is None:
+        load_profile()
+    starts, rankings = _breakpoints[transpose_class(recipe.reduced_perm)]
+    nbytes = math.prod(recipe.reduced_shape) * dtype.itemsize
+    ranking = rankings[max(bisect_right(starts, nbytes) - 1, 0)]
+    for name in ranking:
+        if name == 'numpy' or supports(name, dtype, len(recipe.reduced_perm)):
+            return name
+    return 'numpy'
+
+
+def select_reduce_backend(nbytes: int) -> str:
+    if _breakpoints is None:
+        load_profile()
+    if 'reduce' not in _breakpoints:
+        return 'numpy'
+    starts, rankings = _breakpoints['reduce']
+    for name in rankings[max(bisect_right(starts, nbytes) - 1, 0)]:
+        if name == 'numpy' or backend_available(name):
+            return name
+    return 'numpy'
+
+
+TUNING_CASES = {
+    TRANSPOSE_2D: lambda n: ((n // 512, 512), (1, 0)),
+    'general': lambda n: ((n // 4096, 64, 64), (2, 0, 1)),
+    'high_rank': lambda n: ((n // 4096, 8, 8, 8, 8), (4, 2, 0, 3, 1)),
+}
+
+
+# reductions over the contiguous axis and over the outer axis, timed together
+REDUCE_CASES = (lambda n: ((n // 512, 512), 'a b -> a'), lambda n: ((n // 512, 512), 'a b -> b'))
+
+
+def _best_time(fn: Callable, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def autotune(path: Optional[str] = None, sizes: Sequence[int] = tuple(1 << k for k in range(14, 26, 2)),
+             repeat: int = 5, dtype=np.float32) -> dict:
+    dtype = np.dtype(dtype)
+    backends = [name for name in BACKENDS if backend_available(name)]
+    breakpoints: Dict[str, List] = {}
+    timings: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for cls, make_case in TUNING_CASES.items():
+        breakpoints[cls] = []
+        timings[cls] = {}
+        for nbytes in sizes:
+            shape, perm = make_case(max(nbytes // dtype.itemsize, 4096))
+            x = np.ones(shape, dtype=dtype)
+            results = {}
+            for name in backends:
+                if not supports(name, dtype, len(perm)):
+                    continue
+                transpose = get_transpose(name)
+                run = (lambda: np.ascontiguousarray(np.transpose(x, perm))) if name == 'numpy' \
+                    else (lambda: transpose(x, perm))
+                run()
+                results[name] = _best_time(run, repeat)
+            timings[cls][str(nbytes)] = results
+            ranking = sorted(results, key=results.get)
+            ranking = ranking[:ranking.index('numpy') + 1]
+            if not breakpoints[cls] or breakpoints[cls][-1][1] != ranking:
+                breakpoints[cls].append([nbytes, ranking])
+        breakpoints[cls][0][0] = 0
+    _tune_reductions(sizes, repeat, dtype, breakpoints, timings)
+    profile = {'version': PROFILE_VERSION, 'dtype': dtype.str, 'breakpoints': breakpoints, 'timings': timings}
+    path = path or os.environ.get(PROFILE_ENV) or DEFAULT_PROFILE_PATH
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2)
+    load_profile(path)
+    return profile
+
+
+def _tune_reductions(sizes: Sequence[int], repeat: int, dtype: np.dtype, breakpoints: Dict[str, List],
+                     timings: Dict[str, Dict[str, Dict[str, float]]]) -> None:
+    from .core import Rearrange
+    from .reduction import numba_reducible, reduce_numpy
+    breakpoints['reduce'] = [[0, ['numpy']]]
+    timings['reduce'] = {}
+    if not backend_available('numba') or not numba_reducible(dtype):
+        return
+    from .numba_backend import reduce_numba
+    planner = Rearrange()
+    for nbytes in sizes:
+        results = {'numpy': 0.0, 'numba': 0.0}
+        for make_case in REDUCE_CASES:
+            shape, pattern = make_case(max(nbytes // dtype.itemsize, 4096))
+            x = np.ones(shape, dtype=dtype)
+            recipe = planner.plan_reduce(pattern, shape, dtype, {})
+            for name, reduce in (('numpy', reduce_numpy), ('numba', reduce_numba)):
+                reduce(x, recipe, 'sum')
+                results[name] += _best_time(lambda: reduce(x, recipe, 'sum'), repeat)
+        timings['reduce'][str(nbytes)] = results
+        ranking = sorted(results, key=results.get)
+        ranking = ranking[:ranking.index('numpy') + 1]
+        if breakpoints['reduce'][-1][1] != ranking:
+            breakpoints['reduce'].append([nbytes, ranking])
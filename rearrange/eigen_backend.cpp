@@ -1,313 +1,239 @@
-#define EIGEN_STACK_ALLOCATION_LIMIT 10000000
 #define EIGEN_USE_THREADS
-#define EIGEN_DONT_PARALLELIZE
 
 #include <unsupported/Eigen/CXX11/Tensor>
 #include <pybind11/pybind11.h>
 #include <pybind11/numpy.h>
 #include <pybind11/stl.h>
-#include <vector>
+#include <algorithm>
+#include <cstdint>
+#include <cstring>
+#include <memory>
+#include <mutex>
 #include <string>
-#include <map>
-#include <set>
-#include <sstream>
-#include <regex>
+#include <thread>
+#include <vector>
 #include <stdexcept>
-#include <algorithm>
-#include <iterator>
 
 namespace py = pybind11;
 using Index = Eigen::Index;
-using TensorFixed = Eigen::Tensor<float, 10, Eigen::RowMajor>;
 
-class ParserError : public std::runtime_error {
-public:
-    explicit ParserError(const std::string& message) : std::runtime_error(message) {}
-    EIGEN_MAKE_ALIGNED_OPERATOR_NEW
-};
+constexpr int kMaxRank = 8;
+// below this many elements the pool hand-off costs more than the shuffle itself
+constexpr Index kParallelThreshold = 1 << 15;
 
-struct AxisSpec {
-    std::string name;
-    bool is_group;
-    bool is_ellipsis;
-    AxisSpec(const std::string& n, bool g, bool e) : name(n), is_group(g), is_ellipsis(e) {}
+struct Pool {
+    explicit Pool(int threads) : pool(threads), device(&pool, threads) {}
+    Eigen::ThreadPool pool;
+    Eigen::ThreadPoolDevice device;
 };
 
-class PatternParser {
-public:
-    static std::pair<std::vector<AxisSpec>, std::vector<AxisSpec>> parse(
-        const std::string& input_spec_str, const std::string& output_spec_str) {
-        std::vector<AxisSpec> input_spec = parse_spec(input_spec_str);
-        std::vector<AxisSpec> output_spec = parse_spec(output_spec_str);
-
-        bool input_has_ellipsis = std::any_of(input_spec.begin(), input_spec.end(),
-                                               [](const AxisSpec &s){ return s.is_ellipsis; });
-        bool output_has_ellipsis = std::any_of(output_spec.begin(), output_spec.end(),
-                                                [](const AxisSpec &s){ return s.is_ellipsis; });
-        if (input_has_ellipsis != output_has_ellipsis) {
-            throw ParserError("Ellipsis must be present in both input and output or neither");
-        }
-
-        std::set<std::string> input_axes, output_axes;
-        for (const auto& item : input_spec) {
-            if (!item.is_ellipsis && item.name != "1" && !item.is_group)
-                input_axes.insert(item.name);
-        }
-        for (const auto& item : output_spec) {
-            if (!item.is_ellipsis && !item.is_group)
-                output_axes.insert(item.name);
-        }
+std::mutex pool_mutex;
+std::shared_ptr<Pool> pool_instance;
+int pool_threads = std::max(1u, std::thread::hardware_concurrency());
 
-        std::set<std::string> missing = output_axes;
-        for (const auto& ax : input_axes)
-            missing.erase(ax);
-        if (!missing.empty()) {
-            bool has_one = std::any_of(input_spec.begin(), input_spec.end(),
-                                       [](const AxisSpec &s){ return s.name == "1"; });
-            if (!has_one) {
-                throw ParserError("Output axes not in input without '1': " + set_to_string(missing));
-            }
-        }
+std::shared_ptr<Pool> current_pool() {
+    std::lock_guard<std::mutex> lock(pool_mutex);
+    if (pool_threads > 1 && !pool_instance)
+        pool_instance = std::make_shared<Pool>(pool_threads);
+    return pool_instance;
+}
 
-        return std::make_pair(input_spec, output_spec);
+void set_num_threads(int threads) {
+    if (threads < 1)
+        throw std::invalid_argument("Thread count must be at least 1");
+    std::lock_guard<std::mutex> lock(pool_mutex);
+    if (threads != pool_threads) {
+        pool_threads = threads;
+        pool_instance.reset();
     }
+}
 
-private:
-    static std::vector<AxisSpec> parse_spec(const std::string& spec_str) {
-        std::regex token_re(R"(\w+|->|\.\.\.|\(|\)|1)");
-        std::sregex_iterator it(spec_str.begin(), spec_str.end(), token_re);
-        std::sregex_iterator end;
-        std::vector<std::string> tokens;
-        for (; it != end; ++it) {
-            tokens.push_back(it->str());
-        }
-        if (tokens.empty())
-            throw ParserError("Empty pattern string");
-
-        std::vector<AxisSpec> spec;
-        std::vector<std::string> group;
-        bool in_group = false;
-
-        for (size_t i = 0; i < tokens.size(); ++i) {
-            const std::string& token = tokens[i];
-            if (token == "(") {
-                if (in_group)
-                    throw ParserError("Nested parentheses not supported");
-                in_group = true;
-                group.clear();
-            } else if (token == ")") {
-                if (!in_group)
-                    throw ParserError("Unmatched closing parenthesis");
-                in_group = false;
-                for (const auto& ax : group)
-                    spec.push_back(AxisSpec(ax, true, false));
-            } else if (token == "->") {
-                throw ParserError("Unexpected '->' in specification");
-            } else if (token == "...") {
-                if (std::any_of(spec.begin(), spec.end(),
-                                [](const AxisSpec &s){ return s.is_ellipsis; }))
-                    throw ParserError("Multiple ellipses not supported");
-                if (in_group)
-                    group.push_back(token);
-                else
-                    spec.push_back(AxisSpec("...", false, true));
-            } else if (std::regex_match(token, std::regex("\\w+|1"))) {
-                if (in_group)
-                    group.push_back(token);
-                else
-                    spec.push_back(AxisSpec(token, false, false));
-            } else {
-                throw ParserError("Invalid token: " + token);
-            }
-        }
-        if (in_group)
-            throw ParserError("Unclosed parenthesis");
+int get_num_threads() {
+    std::lock_guard<std::mutex> lock(pool_mutex);
+    return pool_threads;
+}
 
-        return spec;
+template <typename T, int Rank>
+void shuffle(const void* src, void* dst, const std::vector<Index>& shape, const std::vector<Index>& perm,
+             const Pool* pool) {
+    Eigen::array<Index, Rank> in_dims;
+    Eigen::array<Index, Rank> out_dims;
+    Eigen::array<Index, Rank> shuffle_perm;
+    Index size = 1;
+    for (int i = 0; i < Rank; ++i) {
+        in_dims[i] = shape[i];
+        shuffle_perm[i] = perm[i];
+        out_dims[i] = shape[perm[i]];
+        size *= shape[i];
     }
+    Eigen::TensorMap<const Eigen::Tensor<const T, Rank, Eigen::RowMajor>> in(static_cast<const T*>(src), in_dims);
+    Eigen::TensorMap<Eigen::Tensor<T, Rank, Eigen::RowMajor>> out(static_cast<T*>(dst), out_dims);
+    if (pool && size >= kParallelThreshold)
+        out.device(pool->device) = in.shuffle(shuffle_perm);
+    else
+        out = in.shuffle(shuffle_perm);
+}
 
-    static std::string set_to_string(const std::set<std::string>& s) {
-        std::ostringstream oss;
-        for (const auto& item : s)
-            oss << item << " ";
-        return oss.str();
+template <typename T>
+void shuffle_rank(const void* src, void* dst, const std::vector<Index>& shape, const std::vector<Index>& perm,
+                  const Pool* pool) {
+    switch (shape.size()) {
+        case 1: shuffle<T, 1>(src, dst, shape, perm, pool); break;
+        case 2: shuffle<T, 2>(src, dst, shape, perm, pool); break;
+        case 3: shuffle<T, 3>(src, dst, shape, perm, pool); break;
+        case 4: shuffle<T, 4>(src, dst, shape, perm, pool); break;
+        case 5: shuffle<T, 5>(src, dst, shape, perm, pool); break;
+        case 6: shuffle<T, 6>(src, dst, shape, perm, pool); break;
+        case 7: shuffle<T, 7>(src, dst, shape, perm, pool); break;
+        case 8: shuffle<T, 8>(src, dst, shape, perm, pool); break;
     }
-    EIGEN_MAKE_ALIGNED_OPERATOR_NEW
-};
+}
 
-TensorFixed rearrange(py::array_t<float> tensor, std::string input_spec_str,
-                      std::string output_spec_str, py::dict axes_lengths_dict) {
-    std::map<std::string, Index> axes_lengths;
-    for (auto item : axes_lengths_dict) {
-        axes_lengths[item.first.cast<std::string>()] = item.second.cast<Index>();
+using ShuffleFn = void (*)(const void*, void*, const std::vector<Index>&, const std::vector<Index>&, const Pool*);
+
+// Rearranging only moves bytes, so items are shuffled as unsigned words of their size whatever the dtype.
+// Other sizes, and buffers the word type would access misaligned, take the byte-copying gather below.
+ShuffleFn select_kernel(py::ssize_t itemsize, const void* src, const void* dst) {
+    const auto aligned = [&](std::size_t align) {
+        return reinterpret_cast<std::uintptr_t>(src) % align == 0 && reinterpret_cast<std::uintptr_t>(dst) % align == 0;
+    };
+    switch (itemsize) {
+        case 1: return &shuffle_rank<uint8_t>;
+        case 2: return aligned(2) ? &shuffle_rank<uint16_t> : nullptr;
+        case 4: return aligned(4) ? &shuffle_rank<uint32_t> : nullptr;
+        case 8: return aligned(8) ? &shuffle_rank<uint64_t> : nullptr;
     }
+    return nullptr;
+}
 
-    auto tensor_info = tensor.request();
-    std::vector<Index> in_shape(tensor_info.shape.begin(), tensor_info.shape.end());
-    if (in_shape.size() > 10)
-        throw std::runtime_error("Tensor rank exceeds maximum supported dimensions (10)");
-
-    Eigen::array<Index, 10> dims;
-    std::fill(dims.begin(), dims.end(), 1);
-    for (size_t i = 0; i < in_shape.size(); ++i)
-        dims[i] = in_shape[i];
-
-    Eigen::TensorMap<TensorFixed> tensor_map(static_cast<float*>(tensor_info.ptr), dims);
-
-    auto specs = PatternParser::parse(input_spec_str, output_spec_str);
-    std::vector<AxisSpec>& input_spec = specs.first;
-    std::vector<AxisSpec>& output_spec = specs.second;
-
-    std::map<std::string, Index> axis_sizes = axes_lengths;
-    size_t shape_pos = 0;
-    int ellipsis_dims = 0;
-    for (const auto& item : input_spec) {
-        if (item.is_ellipsis) {
-            ellipsis_dims = static_cast<int>(in_shape.size() - (input_spec.size() - 1));
-            for (int j = 0; j < ellipsis_dims; ++j) {
-                axis_sizes["batch_" + std::to_string(j)] = in_shape[shape_pos++];
-            }
-        } else if (item.name == "1") {
-            if (shape_pos >= in_shape.size() || in_shape[shape_pos] != 1)
-                throw std::runtime_error("Expected singleton axis at position " + std::to_string(shape_pos));
-            shape_pos++;
-        } else if (!item.is_group) {
-            if (shape_pos >= in_shape.size())
-                throw std::runtime_error("Input tensor has too few dimensions");
-            axis_sizes[item.name] = in_shape[shape_pos++];
-        } else {
-            shape_pos++;
-        }
+// Copies a strided source into the C-ordered destination. `src_strides` are the signed byte strides of
+// the source for each output axis. The output is walked in tiles over axis a (innermost output axis)
+// and axis b (the one the source is densest along); the other axes are outer loops. Size 0 stands for
+// an item size only known at run time.
+template <std::size_t Size>
+void gather(const char* src, char* dst, const std::vector<Index>& out_shape, const std::vector<Index>& src_strides,
+            Index itemsize, const Pool* pool) {
+    const Index size = Size ? static_cast<Index>(Size) : itemsize;
+    const int n = static_cast<int>(out_shape.size());
+    std::vector<Index> dst_strides(n);
+    Index total = 1;
+    for (int ax = n - 1; ax >= 0; --ax) {
+        dst_strides[ax] = total * size;
+        total *= out_shape[ax];
     }
-
-    std::vector<Index> intermediate_shape;
-    std::vector<std::string> intermediate_axes;
-    std::vector<std::pair<int, Index>> repeat_ops;
-    shape_pos = 0;
-    for (size_t i = 0; i < input_spec.size(); ++i) {
-        const auto& item = input_spec[i];
-        if (item.is_ellipsis) {
-            for (int j = 0; j < ellipsis_dims; ++j) {
-                intermediate_shape.push_back(in_shape[shape_pos]);
-                intermediate_axes.push_back("batch_" + std::to_string(j));
-                shape_pos++;
-            }
-        } else if (item.name == "1") {
-            intermediate_shape.push_back(1);
-            std::string out_axis = output_spec[i].name;
-            Index new_size = axes_lengths.at(out_axis);
-            intermediate_axes.push_back(out_axis);
-            repeat_ops.emplace_back(static_cast<int>(intermediate_shape.size()-1), new_size);
-            shape_pos++;
-        } else if (item.is_group) {
-            Index group_size = in_shape[shape_pos++];
-            std::vector<std::string> group_axes;
-            while (i < input_spec.size() && input_spec[i].is_group) {
-                group_axes.push_back(input_spec[i].name);
-                i++;
+    const int a = n - 1;
+    int b = a;
+    for (int ax = 0; ax < a; ++ax)
+        if (out_shape[ax] > 1 && (b == a || std::abs(src_strides[ax]) < std::abs(src_strides[b])))
+            b = ax;
+    const Index block = size <= 4 ? 32 : 16;
+    const Index size_a = out_shape[a], size_b = b == a ? 1 : out_shape[b];
+    const Index src_b = b == a ? 0 : src_strides[b], dst_b = b == a ? 0 : dst_strides[b];
+    const Index tiles_a = (size_a + block - 1) / block, tiles_b = (size_b + block - 1) / block;
+    Index outer = 1;
+    for (int ax = 0; ax < n; ++ax)
+        if (ax != a && ax != b)
+            outer *= out_shape[ax];
+    auto work = [&](Index first, Index last) {
+        for (Index t = first; t < last; ++t) {
+            const Index ta = t % tiles_a;
+            Index rem = t / tiles_a;
+            const Index tb = rem % tiles_b;
+            rem /= tiles_b;
+            Index src_off = 0, dst_off = 0;
+            for (int ax = n - 1; ax >= 0; --ax) {
+                if (ax == a || ax == b)
+                    continue;
+                const Index i = rem % out_shape[ax];
+                rem /= out_shape[ax];
+                src_off += i * src_strides[ax];
+                dst_off += i * dst_strides[ax];
             }
-            i--;
-            Index known_product = 1;
-            int unknown_count = 0;
-            std::string unknown_axis;
-            for (const auto& ax : group_axes) {
-                if (axes_lengths.find(ax) != axes_lengths.end()) {
-                    known_product *= axes_lengths[ax];
-                } else {
-                    unknown_count++;
-                    unknown_axis = ax;
-                }
+            const Index a1 = std::min((ta + 1) * block, size_a), b1 = std::min((tb + 1) * block, size_b);
+            for (Index j = tb * block; j < b1; ++j) {
+                const char* s = src + src_off + j * src_b;
+                char* d = dst + dst_off + j * dst_b;
+                for (Index i = ta * block; i < a1; ++i)
+                    std::memcpy(d + i * size, s + i * src_strides[a], Size ? Size : size);
             }
-            if (unknown_count > 1)
-                throw std::runtime_error("Too many unknown sizes in group");
-            else if (unknown_count == 1)
-                axis_sizes[unknown_axis] = group_size / known_product;
-            else if (known_product != group_size)
-                throw std::runtime_error("Group size mismatch");
-            for (const auto& ax : group_axes) {
-                intermediate_shape.push_back(axis_sizes[ax]);
-                intermediate_axes.push_back(ax);
-            }
-        } else {
-            intermediate_shape.push_back(axis_sizes[item.name]);
-            intermediate_axes.push_back(item.name);
-            shape_pos++;
         }
-    }
-
-    Eigen::DSizes<Index, 10> intermediate_dims;
-    std::fill(intermediate_dims.begin(), intermediate_dims.end(), 1);
-    int inter_rank = static_cast<int>(intermediate_shape.size());
-    for (int i = 0; i < inter_rank; ++i)
-        intermediate_dims[i] = intermediate_shape[i];
+    };
+    const Index tiles = outer * tiles_a * tiles_b;
+    if (pool && total >= kParallelThreshold)
+        pool->device.parallelFor(tiles, Eigen::TensorOpCost(size * block * block, size * block * block, 0), work);
+    else
+        work(0, tiles);
+}
 
-    auto reshaped = tensor_map.reshape(intermediate_dims);
+using GatherFn = void (*)(const char*, char*, const std::vector<Index>&, const std::vector<Index>&, Index,
+                          const Pool*);
 
-    for (const auto& op : repeat_ops) {
-        int axis = op.first;
-        Index repeats = op.second;
-        Eigen::DSizes<Index, 10> reps;
-        std::fill(reps.begin(), reps.end(), 1);
-        reps[axis] = repeats;
-        reshaped = reshaped.broadcast(reps);
-        intermediate_dims[axis] *= repeats; 
+GatherFn select_gather(py::ssize_t itemsize) {
+    switch (itemsize) {
+        case 1: return &gather<1>;
+        case 2: return &gather<2>;
+        case 4: return &gather<4>;
+        case 8: return &gather<8>;
+        case 16: return &gather<16>;
     }
+    return &gather<0>;
+}
 
-    std::vector<Index> perm_vec;
-    std::vector<Index> new_shape;
-    for (size_t i = 0; i < output_spec.size(); ++i) {
-        const auto& item = output_spec[i];
-        if (item.is_ellipsis) {
-            for (int j = 0; j < ellipsis_dims; ++j) {
-                auto it = std::find(intermediate_axes.begin(), intermediate_axes.end(),
-                                    "batch_" + std::to_string(j));
-                Index idx = std::distance(intermediate_axes.begin(), it);
-                perm_vec.push_back(idx);
-                new_shape.push_back(intermediate_shape[idx]);
-            }
-        } else if (!item.is_group) {
-            auto it = std::find(intermediate_axes.begin(), intermediate_axes.end(), item.name);
-            Index idx = std::distance(intermediate_axes.begin(), it);
-            perm_vec.push_back(idx);
-            new_shape.push_back(intermediate_shape[idx]);
-        } else {
-            Index group_size = 1;
-            std::vector<std::string> group_axes;
-            while (i < output_spec.size() && output_spec[i].is_group) {
-                group_axes.push_back(output_spec[i].name);
-                auto it = std::find(intermediate_axes.begin(), intermediate_axes.end(), output_spec[i].name);
-                perm_vec.push_back(std::distance(intermediate_axes.begin(), it));
-                i++;
-            }
-            i--;
-            for (const auto& ax : group_axes)
-                group_size *= axis_sizes[ax];
-            new_shape.push_back(group_size);
-        }
+py::array transpose(py::array tensor, std::vector<Index> perm, py::object out) {
+    const bool contiguous = tensor.flags() & py::array::c_style;
+    std::vector<Index> shape(tensor.shape(), tensor.shape() + tensor.ndim());
+    const int rank = static_cast<int>(shape.size());
+    if (static_cast<int>(perm.size()) != rank)
+        throw std::runtime_error("Permutation length does not match tensor rank");
+    if (rank < 1 || rank > kMaxRank)
+        throw std::runtime_error("Tensor rank " + std::to_string(rank) + " is outside the supported range [1, "
+                                 + std::to_string(kMaxRank) + "]");
+    for (int i = 0; i < rank; ++i)
+        if (perm[i] < 0 || perm[i] >= rank)
+            throw std::runtime_error("Permutation entry " + std::to_string(perm[i]) + " is out of range");
+    if (tensor.dtype().attr("hasobject").cast<bool>())
+        throw py::type_error("Unsupported dtype for the Eigen backend: " + std::string(py::str(tensor.dtype())));
+    const Index itemsize = tensor.itemsize();
+    GatherFn gather_kernel = select_gather(itemsize);
+
+    std::vector<py::ssize_t> out_shape(rank);
+    for (int i = 0; i < rank; ++i)
+        out_shape[i] = static_cast<py::ssize_t>(shape[perm[i]]);
+    py::array result;
+    if (out.is_none()) {
+        result = py::array(tensor.dtype(), out_shape);
+    } else {
+        result = out.cast<py::array>();
+        if (!py::detail::npy_api::get().PyArray_EquivTypes_(result.dtype().ptr(), tensor.dtype().ptr()))
+            throw std::runtime_error("Output dtype mismatch: expected " + std::string(py::str(tensor.dtype()))
+                                     + ", got " + std::string(py::str(result.dtype())));
+        if (result.ndim() != rank || !std::equal(out_shape.begin(), out_shape.end(), result.shape()))
+            throw std::runtime_error("Output shape does not match the permuted tensor shape");
+        if (!(result.flags() & py::array::c_style) || !result.writeable())
+            throw std::runtime_error("Output array must be C-contiguous and writeable");
+    }
+    const void* src = tensor.data();
+    void* dst = result.mutable_data();
+    ShuffleFn kernel = contiguous ? select_kernel(itemsize, src, dst) : nullptr;
+    std::shared_ptr<Pool> pool = current_pool();
+    std::vector<Index> src_strides(rank);
+    for (int i = 0; i < rank; ++i)
+        src_strides[i] = tensor.strides(perm[i]);
+    {
+        py::gil_scoped_release release;
+        if (kernel)
+            kernel(src, dst, shape, perm, pool.get());
+        else if (tensor.size() > 0)
+            gather_kernel(static_cast<const char*>(src), static_cast<char*>(dst), std::vector<Index>(
+                out_shape.begin(), out_shape.end()), src_strides, itemsize, pool.get());
     }
-
-    Eigen::DSizes<Index, 10> final_dims;
-    std::fill(final_dims.begin(), final_dims.end(), 1);
-    int out_rank = static_cast<int>(new_shape.size());
-    for (int i = 0; i < out_rank; ++i)
-        final_dims[i] = new_shape[i];
-
-    Eigen::array<Index, 10> perm_fixed;
-    for (int i = 0; i < 10; ++i)
-        perm_fixed[i] = i;
-    for (int i = 0; i < static_cast<int>(perm_vec.size()); ++i)
-        perm_fixed[i] = perm_vec[i];
-
-    auto shuffled = reshaped.shuffle(perm_fixed);
-    auto final_view = shuffled.reshape(final_dims);
-
-    TensorFixed result(final_dims);
-    result = final_view.eval();
-
     return result;
 }
 
 PYBIND11_MODULE(eigen_backend, m) {
-    m.def("rearrange_eigen", &rearrange, "Rearrange tensor using Eigen",
-          py::arg("tensor"), py::arg("input_spec"), py::arg("output_spec"), py::arg("axes_lengths"));
+    m.def("transpose", &transpose, "Permute the axes of a tensor with any strides into `out` or a new NumPy array",
+          py::arg("tensor"), py::arg("perm"), py::arg("out") = py::none());
+    m.def("set_num_threads", &set_num_threads, "Set the size of the Eigen thread pool", py::arg("threads"));
+    m.def("get_num_threads", &get_num_threads, "Size of the Eigen thread pool");
+    m.attr("max_rank") = kMaxRank;
 }
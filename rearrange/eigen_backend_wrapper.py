@@ -1,9 +1,23 @@
 import numpy as np
-from .eigen_backend import rearrange_eigen
+from .chunked import open_output
+from .plan import movable
+from .eigen_backend import max_rank, set_num_threads, transpose
+
+def transpose_eigen(tensor: np.ndarray, perm, out: np.ndarray = None) -> np.ndarray:
+    if out is not None:
+        out = open_output(out, tuple(tensor.shape[p] for p in perm), tensor.dtype)
+    # the extension moves items by their size alone, so any dtype without Python objects qualifies
+    if not movable(tensor.dtype) or not 1 <= len(perm) <= max_rank or \
+            (out is not None and not out.flags.c_contiguous):
+        if out is None:
+            return np.transpose(tensor, perm).copy()
+        np.copyto(out, np.transpose(tensor, perm))
+        return out
+    return transpose(tensor, list(perm), out)
 
 def rearrange_eigen(tensor: np.ndarray, input_spec: list, output_spec: list,
                     axes_lengths: dict) -> np.ndarray:
-    tensor = np.ascontiguousarray(tensor)
-    input_spec_str = ' '.join(str(x) for x in input_spec)
-    output_spec_str = ' '.join(str(x) for x in output_spec)
-    return rearrange_eigen(tensor, input_spec_str, output_spec_str, axes_lengths)
\ No newline at end of file
+    from .core import Rearrange
+    r = Rearrange(use_eigen=True)
+    recipe = r._build_recipe(tensor.shape, input_spec, output_spec, axes_lengths)
+    return r._execute(tensor, recipe)
@@ -0,0 +1,136 @@
+from collections import namedtuple
+from typing import Dict, List
+
+import numpy as np
+
+# Row error codes reported by infer(); index into ERRORS for a name
+OK = 0
+SINGLETON_MISMATCH = 1
+LITERAL_MISMATCH = 2
+GROUP_MISMATCH = 3
+GROUP_NOT_DIVISIBLE = 4
+AXIS_DROPPED = 5
+SIZE_MISMATCH = 6
+ERRORS = ('ok', 'singleton_mismatch', 'literal_mismatch', 'group_mismatch', 'group_not_divisible',
+          'axis_dropped', 'size_mismatch')
+
+# `shape` has -1 and `nbytes` -1 on rows whose `error` is not OK; `view` tells whether the
+# result of a C-contiguous input can be a view of it
+Inference = namedtuple('Inference', ['shape', 'nbytes', 'view', 'error'])
+
+
+def _flag(errors: np.ndarray, bad: np.ndarray, code: int) -> None:
+    # the first error of a row wins
+    errors[(errors == OK) & bad] = code
+
+
+def infer_shapes(planner, input_spec: list, output_spec: list, shapes: np.ndarray, itemsize: int,
+                 axes_lengths: Dict[str, int]) -> Inference:
+    # Everything that depends only on the pattern and the rank raises; every check on the sizes is
+    # done for all rows at once and recorded in the row's error code.
+    rows, ndim = shapes.shape
+    total = np.prod(shapes, axis=1)
+    errors = np.zeros(rows, dtype=np.int8)
+    sizes: Dict[str, np.ndarray] = {}
+    order: List[str] = []
+    pos = 0
+
+    def dim() -> np.ndarray:
+        if pos >= ndim:
+            raise ValueError("Mismatch between consumed axes and tensor dimensions")
+        return shapes[:, pos]
+
+    for i, token in enumerate(input_spec):
+        if token == '...':
+            ellipsis_dims = ndim - pos - planner._effective_tokens(input_spec[i + 1:], output_spec)
+            if ellipsis_dims < 0:
+                raise ValueError("Not enough axes for ellipsis")
+            for j in range(ellipsis_dims):
+                sizes[f'batch_{j}'] = dim()
+                order.append(f'batch_{j}')
+                pos += 1
+        elif token == '1':
+            _flag(errors, dim() != 1, SINGLETON_MISMATCH)
+            sizes[f'singleton_{i}'] = np.ones(rows, dtype=np.int64)
+            order.append(f'singleton_{i}')
+            pos += 1
+        elif isinstance(token, tuple):
+            size = dim()
+            unknown = [ax for ax in token if ax not in axes_lengths]
+            if len(unknown) > 1:
+                raise ValueError("Too many unspecified axes in group")
+            known = int(np.prod([axes_lengths[ax] for ax in token if ax in axes_lengths]))
+            for ax in token:
+                if ax in axes_lengths:
+                    sizes[ax] = np.full(rows, axes_lengths[ax], dtype=np.int64)
+            if unknown:
+                # like the planner, an uneven split only fails when the input holds any elements
+                divisor = max(known, 1)
+                _flag(errors, ((size % divisor != 0) & (total != 0)) | (known == 0), GROUP_NOT_DIVISIBLE)
+                sizes[unknown[0]] = size // divisor
+            else:
+                _flag(errors, size != known, GROUP_MISMATCH)
+            order.extend(token)
+            pos += 1
+        elif token.isdigit():
+            _flag(errors, dim() != int(token), LITERAL_MISMATCH)
+            if token in output_spec:
+                sizes[token] = dim()
+                order.append(token)
+            pos += 1
+        else:
+            sizes[token] = dim()
+            order.append(token)
+            pos += 1
+    if pos != ndim:
+        raise ValueError("Mismatch between consumed axes and tensor dimensions")
+    if len(set(order)) != len(order):
+        raise ValueError("Repeated dimension name")
+
+    missing = planner.parser.get_axes(output_spec) - planner.parser.get_axes(input_spec)
+    for ax in sorted(missing):
+        if ax not in axes_lengths:
+            raise ValueError(f"Output axis '{ax}' not in input and not specified")
+        sizes[ax] = np.full(rows, axes_lengths[ax], dtype=np.int64)
+    groups: List[List[str]] = []
+    for token in output_spec:
+        if token == '...':
+            groups.extend([ax] for ax in order if ax.startswith('batch_'))
+        elif isinstance(token, tuple):
+            groups.append(list(token))
+        elif token == '1':
+            groups.append([])
+        else:
+            groups.append([token])
+    written = [ax for group in groups for ax in group]
+    if len(set(written)) != len(written):
+        raise ValueError("Repeated dimension name")
+
+    ones = np.ones(rows, dtype=np.int64)
+    inter = np.stack([sizes[ax] for ax in order], axis=1) if order else np.ones((rows, 0), dtype=np.int64)
+    dropped = [k for k, ax in enumerate(order) if ax not in written]
+    _flag(errors, np.prod(inter[:, dropped], axis=1) != 1, AXIS_DROPPED)
+    final = np.stack([np.prod([sizes[ax] for ax in group], axis=0) if group else ones for group in groups],
+                     axis=1) if groups else np.ones((rows, 0), dtype=np.int64)
+    _flag(errors, np.prod(inter, axis=1) != np.prod(final, axis=1), SIZE_MISMATCH)
+
+    # A C-contiguous input splits into a C-contiguous intermediate, so an output group can be
+    # merged without a copy when its axes of size > 1 follow each other in the input order.
+    index = {ax: k for k, ax in enumerate(order)}
+    nonunit = inter > 1
+    view = np.ones(rows, dtype=bool)
+    for group in groups:
+        axes = [index[ax] for ax in group if ax in index]
+        for u in range(len(axes)):
+            for v in range(u + 1, len(axes)):
+                p, q = axes[u], axes[v]
+                neighbours = nonunit[:, p] & nonunit[:, q] & ~nonunit[:, axes[u + 1:v]].any(axis=1)
+                if p < q:
+                    neighbours &= nonunit[:, p + 1:q].any(axis=1)
+                view &= ~neighbours
+    view |= total == 0
+
+    valid = errors == OK
+    final = np.where(valid[:, None], final, -1)
+    nbytes = np.where(valid, np.prod(final, axis=1) * itemsize, -1)
+    return Inference(final, nbytes, view & valid, errors)
@@ -0,0 +1,77 @@
+import math
+
+import numpy as np
+
+from .plan import movable, word_dtype
+from .optimizer import IDENTITY
+
+
+def follow_cycles(data: np.ndarray, out_shape: np.ndarray, src_strides: np.ndarray, visited: np.ndarray) -> None:
+    # Row j of the C-ordered output is row src(j) of the input. Every cycle of that permutation is
+    # walked once, moving each row into the slot it came from; `visited` holds one bit per row.
+    # Also compiled by numba_backend, so it sticks to what numba accepts.
+    rows = data.shape[0]
+    nd = out_shape.shape[0]
+    first = np.empty_like(data[0, :])
+    for start in range(rows):
+        if visited[start >> 3] & (1 << (start & 7)):
+            continue
+        first[:] = data[start, :]
+        j = start
+        while True:
+            visited[j >> 3] |= 1 << (j & 7)
+            rem = j
+            s = 0
+            for ax in range(nd - 1, -1, -1):
+                s += (rem % out_shape[ax]) * src_strides[ax]
+                rem //= out_shape[ax]
+            if s == start:
+                data[j, :] = first
+                break
+            data[j, :] = data[s, :]
+            j = s
+
+
+def check_inplace(tensor: np.ndarray) -> None:
+    if not isinstance(tensor, np.ndarray):
+        raise ValueError(f"Cannot rearrange in place: expected a NumPy array, got {type(tensor).__name__}")
+    if not tensor.flags.c_contiguous:
+        raise ValueError("Cannot rearrange in place: the input is not C-contiguous")
+    if not tensor.flags.writeable:
+        raise ValueError("Cannot rearrange in place: the input is read-only")
+
+
+def check_inplace_pattern(parser, input_spec: list, output_spec: list) -> None:
+    # only a permutation of the same elements fits in the input buffer; checked before planning,
+    # which would otherwise fail with a generic size mismatch
+    added = parser.get_axes(output_spec) - parser.get_axes(input_spec)
+    if added:
+        raise ValueError(f"Cannot rearrange in place: output axes {tuple(sorted(added))} are not in the input")
+
+
+def rearrange_inplace(tensor: np.ndarray, recipe) -> np.ndarray:
+    # Permutes the elements inside the input's own buffer and returns it reshaped to the output
+    # shape. Axes that keep their place at the end of the order move together as one row, so
+    # the only extra memory is one row and one bit per row.
+    check_inplace(tensor)
+    if recipe.drop_index is not None or math.prod(recipe.intermediate_shape) != tensor.size:
+        raise ValueError("Cannot rearrange in place: the pattern drops input elements")
+    if recipe.kind == IDENTITY or tensor.size == 0:
+        return tensor.reshape(recipe.final_shape)
+    shape, perm = recipe.reduced_shape, recipe.reduced_perm
+    row = 1
+    while perm and perm[-1] == len(perm) - 1:
+        row *= shape[-1]
+        shape, perm = shape[:-1], perm[:-1]
+    strides = [math.prod(shape[ax + 1:]) for ax in range(len(shape))]
+    out_shape = np.array([shape[p] for p in perm], dtype=np.int64)
+    src_strides = np.array([strides[p] for p in perm], dtype=np.int64)
+    rows = tensor.reshape(-1, row)
+    visited = np.zeros((rows.shape[0] + 7) // 8, dtype=np.uint8)
+    from . import core
+    if core.numba_available and movable(tensor.dtype):
+        from .numba_backend import inplace_kernel
+        inplace_kernel(rows.view(word_dtype(rows)), out_shape, src_strides, visited)
+    else:
+        follow_cycles(rows, out_shape, src_strides, visited)
+    return tensor.reshape(recipe.final_shape)
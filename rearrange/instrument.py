@@ -0,0 +1,123 @@
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+import numpy as np
+
+CallRecord = namedtuple('CallRecord', ['pattern', 'input_shape', 'output_shape', 'dtype', 'backend',
+                                       'parse_s', 'plan_s', 'execute_s', 'is_view', 'bytes_allocated'])
+
+STAT_FIELDS = ('calls', 'views', 'copies', 'bytes_allocated', 'parse_s', 'plan_s', 'execute_s')
+
+enabled = False
+_callbacks: List[Callable[[CallRecord], None]] = []
+_stats: Dict[str, Dict[str, float]] = {}
+_lock = threading.Lock()
+
+
+def enable() -> None:
+    global enabled
+    enabled = True
+
+
+def disable() -> None:
+    global enabled
+    enabled = False
+
+
+def add_callback(callback: Callable[[CallRecord], None]) -> None:
+    with _lock:
+        _callbacks.append(callback)
+
+
+def remove_callback(callback: Callable[[CallRecord], None]) -> None:
+    with _lock:
+        _callbacks.remove(callback)
+
+
+@contextmanager
+def recording(callback: Callable[[CallRecord], None] = None) -> Iterator[List[CallRecord]]:
+    global enabled
+    records: List[CallRecord] = []
+    callbacks = [records.append] + ([callback] if callback is not None else [])
+    previous = enabled
+    for cb in callbacks:
+        add_callback(cb)
+    enabled = True
+    try:
+        yield records
+    finally:
+        enabled = previous
+        for cb in callbacks:
+            remove_callback(cb)
+
+
+def _shape(value) -> tuple:
+    if isinstance(value, (list, tuple)):
+        return tuple(tuple(v.shape) for v in value)
+    return tuple(value.shape)
+
+
+def observe(pattern: str, tensor: np.ndarray, result: np.ndarray, backend: str,
+            parse_s: float, plan_s: float, execute_s: float, allocated: bool = True) -> None:
+    # `tensor` and `result` may also be lists of arrays (pack and unpack), their shapes are then
+    # recorded as tuples of shapes. `allocated` is False when the result was written to a
+    # caller's buffer; aliasing of non-NumPy arrays is not known, so they count as copies
+    # without allocated bytes
+    inputs = list(tensor) if isinstance(tensor, (list, tuple)) else [tensor]
+    results = list(result) if isinstance(result, (list, tuple)) else [result]
+    numpy = all(isinstance(a, np.ndarray) for a in inputs + results)
+    is_view = numpy and all(any(r is t or (r.base is not None and np.may_share_memory(r, t)) for t in inputs)
+                            for r in results)
+    nbytes = sum(r.nbytes for r in results) if numpy and allocated and not is_view else 0
+    dtype = getattr(inputs[0].dtype, 'str', str(inputs[0].dtype))
+    record = CallRecord(pattern, _shape(tensor), _shape(result), dtype, backend,
+                        parse_s, plan_s, execute_s, is_view, nbytes)
+    with _lock:
+        stats = _stats.get(pattern)
+        if stats is None:
+            stats = _stats[pattern] = dict.fromkeys(STAT_FIELDS, 0)
+        stats['calls'] += 1
+        stats['views' if is_view else 'copies'] += 1
+        stats['bytes_allocated'] += record.bytes_allocated
+        stats['parse_s'] += parse_s
+        stats['plan_s'] += plan_s
+        stats['execute_s'] += execute_s
+        callbacks = list(_callbacks)
+    for cb in callbacks:
+        cb(record)
+
+
+def stats() -> Dict[str, Dict[str, float]]:
+    with _lock:
+        return {pattern: dict(values) for pattern, values in _stats.items()}
+
+
+def reset() -> None:
+    with _lock:
+        _stats.clear()
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(prefix: str = 'rearrange') -> str:
+    # Counters in the Prometheus text exposition format, one series per pattern.
+    help_text = {
+        'calls': 'Number of rearrange calls', 'views': 'Calls that returned a view of the input',
+        'copies': 'Calls that returned a new array', 'bytes_allocated': 'Bytes allocated for results',
+        'parse_s': 'Seconds spent parsing patterns', 'plan_s': 'Seconds spent resolving plans',
+        'execute_s': 'Seconds spent executing plans',
+    }
+    snapshot = stats()
+    lines = []
+    for field in STAT_FIELDS:
+        metric = field[:-2] + '_seconds' if field.endswith('_s') else field
+        name = f"{prefix}_{metric}_total"
+        lines.append(f"# HELP {name} {help_text[field]}")
+        lines.append(f"# TYPE {name} counter")
+        for pattern, values in sorted(snapshot.items()):
+            lines.append(f'{name}{{pattern="{_escape(pattern)}"}} {values[field]}')
+    return '\n'.join(lines) + '\n'
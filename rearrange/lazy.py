@@ -0,0 +1,204 @@
+import time
+from itertools import count
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import instrument
+from .optimizer import classify, coalesce_axes
+from .parser import as_value_error
+
+
+class _Fold:
+    # The array produced so far, described over "atoms": C-ordered pieces of the original input
+    # dimensions. `dims` lists the atoms of every input dimension, `current` the atoms of every
+    # dimension of the array built by the folded steps. Atoms of size 1 are left out.
+    def __init__(self, shape: Tuple[int, ...]):
+        self.ids = count()
+        self.sizes: Dict[int, int] = {}
+        self.dims: List[List[int]] = []
+        for size in shape:
+            self.dims.append([self._atom(size)] if size != 1 else [])
+        self.current = [list(d) for d in self.dims]
+        self.fixed: set = set()
+        self.steps = 0
+
+    def _atom(self, size: int) -> int:
+        atom = next(self.ids)
+        self.sizes[atom] = size
+        return atom
+
+    def _replace(self, old: List[int], new: List[int]) -> None:
+        for dim in self.dims:
+            for i in range(len(dim) - len(old) + 1):
+                if dim[i:i + len(old)] == old:
+                    dim[i:i + len(old)] = new
+                    return
+
+    def _coarsen(self, seq: List[int]) -> List[int]:
+        # atoms that are neighbours both here and within one input dimension become one atom
+        where = {a: (d, i) for d, dim in enumerate(self.dims) for i, a in enumerate(dim)}
+        out: List[int] = []
+        for a in seq:
+            if out:
+                d, i = where[out[-1]]
+                if where[a] == (d, i + 1):
+                    merged = self._atom(self.sizes[out[-1]] * self.sizes[a])
+                    self._replace([out[-1], a], [merged])
+                    where[merged] = (d, i)
+                    for j, b in enumerate(self.dims[d]):
+                        where[b] = (d, j)
+                    out[-1] = merged
+                    continue
+            out.append(a)
+        return out
+
+    def _regroup(self, groups: List[List[int]], shape: Tuple[int, ...]) -> Optional[List[List[int]]]:
+        seq = self._coarsen([a for g in groups for a in g])
+        out, k = [], 0
+        for size in shape:
+            group, acc = [], 1
+            while acc < size:
+                if k == len(seq):
+                    return None
+                a = seq[k]
+                if acc * self.sizes[a] <= size:
+                    group.append(a)
+                    acc *= self.sizes[a]
+                    k += 1
+                    continue
+                outer = size // acc
+                if size % acc or self.sizes[a] % outer:
+                    return None
+                o, i = self._atom(outer), self._atom(self.sizes[a] // outer)
+                self._replace([a], [o, i])
+                seq[k] = i
+                group.append(o)
+                acc *= outer
+            if acc != size:
+                return None
+            out.append(group)
+        return out if k == len(seq) else None
+
+    def apply(self, recipe) -> bool:
+        saved = [list(dim) for dim in self.dims], set(self.fixed)
+        current = self.current
+        if recipe.drop_index is not None:
+            for dim, index in zip(current, recipe.drop_index):
+                if isinstance(index, int):
+                    self.fixed.update(dim)
+            current = [dim for dim, index in zip(current, recipe.drop_index) if not isinstance(index, int)]
+        inter = self._regroup(current, recipe.intermediate_shape)
+        final = None if inter is None else self._regroup([inter[p] for p in recipe.perm], recipe.final_shape)
+        if final is None:
+            self.dims, self.fixed = saved
+            return False
+        self.current = final
+        self.steps += 1
+        return True
+
+    def finish(self, final_shape: Tuple[int, ...]):
+        from .core import Recipe
+        atoms = [a for dim in self.dims for a in dim]
+        pre_shape = tuple(self.sizes[a] for a in atoms)
+        pre_index = tuple(0 if a in self.fixed else slice(None) for a in atoms) if self.fixed else None
+        kept = [a for a in atoms if a not in self.fixed]
+        order = [a for dim in self.current for a in dim]
+        perm = tuple(kept.index(a) for a in order)
+        inter = tuple(self.sizes[a] for a in kept)
+        reduced_shape, reduced_perm = coalesce_axes(inter, perm)
+        recipe = Recipe(None, inter, perm, tuple(final_shape), {}, reduced_shape, reduced_perm,
+                        classify(reduced_perm))
+        return pre_shape, pre_index, recipe
+
+
+def fold(shape: Tuple[int, ...], recipes) -> List[tuple]:
+    # Segments of (pre_shape, pre_index, recipe), each run with a single transpose; a new segment
+    # starts where a reshape would cut through atoms. Unfoldable steps keep their own recipe.
+    shape = tuple(shape)
+    if 0 in shape or any(0 in r.final_shape for r in recipes):
+        return [(None, None, r) for r in recipes]
+    segments = []
+    state = _Fold(shape)
+    for recipe in recipes:
+        if state.apply(recipe):
+            shape = recipe.final_shape
+            continue
+        if state.steps:
+            segments.append(state.finish(shape))
+            state = _Fold(shape)
+            if state.apply(recipe):
+                shape = recipe.final_shape
+                continue
+        segments.append((None, None, recipe))
+        shape = recipe.final_shape
+        state = _Fold(shape)
+    if state.steps:
+        segments.append(state.finish(shape))
+    return segments
+
+
+class LazyRearrange:
+    __slots__ = ('tensor', 'steps', 'shape', '_planner', '_segments')
+
+    def __init__(self, planner, tensor: np.ndarray, steps: Tuple[tuple, ...] = ()):
+        self.tensor = tensor
+        self.steps = steps
+        self.shape = steps[-1][2].final_shape if steps else tuple(tensor.shape)
+        self._planner = planner
+        self._segments = None
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.tensor.dtype
+
+    def __repr__(self) -> str:
+        patterns = ', '.join(repr(pattern) for pattern, _, _ in self.steps)
+        return f"LazyRearrange(shape={self.shape}, steps=[{patterns}])"
+
+    def rearrange(self, pattern: str, **axes_lengths: int) -> 'LazyRearrange':
+        # planned right away, so a chain that does not fit the shapes fails where it is written
+        try:
+            recipe = self._planner.plan(pattern, self.shape, self.tensor.dtype, axes_lengths)
+        except Exception as e:
+            raise as_value_error(e)
+        return LazyRearrange(self._planner, self.tensor, self.steps + ((pattern, axes_lengths, recipe),))
+
+    def segments(self) -> List[tuple]:
+        if self._segments is None:
+            self._segments = fold(self.tensor.shape, [recipe for _, _, recipe in self.steps])
+        return self._segments
+
+    def compute(self) -> np.ndarray:
+        try:
+            if instrument.enabled:
+                return self._compute_instrumented()
+            return self._run(self.segments())[0]
+        except Exception as e:
+            raise as_value_error(e)
+
+    def _run(self, segments: List[tuple]) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[tuple]]:
+        # the result, and the input and recipe of the last segment
+        tensor, last_input, recipe = self.tensor, None, None
+        for pre_shape, pre_index, recipe in segments:
+            if pre_index is not None:
+                tensor = tensor.reshape(pre_shape)[pre_index]
+            last_input = tensor
+            tensor = self._planner._execute(tensor, recipe)
+        return tensor, last_input, recipe
+
+    def _compute_instrumented(self) -> np.ndarray:
+        # one record for the whole chain; its steps were planned when they were added
+        start = time.perf_counter()
+        segments = self.segments()
+        folded = time.perf_counter()
+        result, last_input, recipe = self._run(segments)
+        done = time.perf_counter()
+        backend = 'numpy' if recipe is None else self._planner.selected_backend(last_input, recipe)
+        instrument.observe(' | '.join(pattern for pattern, _, _ in self.steps), self.tensor, result, backend,
+                           0.0, folded - start, done - folded)
+        return result
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        result = self.compute()
+        return result if dtype is None else result.astype(dtype, copy=False)
@@ -1,73 +1,313 @@
+import math
 import numpy as np
 import numba as nb
 
-@nb.njit(parallel=True)
-def rearrange_numba_kernel(data, out, perm, in_shape, out_shape):
-    n = data.size
-    for i in nb.prange(n):
-        coords = np.unravel_index(i, in_shape)
-        new_coords = tuple(coords[p] for p in perm)
-        out_idx = np.ravel_multi_index(new_coords, out_shape)
-        out.flat[out_idx] = data.flat[i]
+from .chunked import open_output
+from .inplace import follow_cycles
+from .plan import movable, reshape_strides, word_dtype
+from .reduction import accumulator_dtype, reduce_layout, result_dtype
 
-def rearrange_numba(tensor: np.ndarray, input_spec: list, output_spec: list,
-                    axes_lengths: dict) -> np.ndarray:
-    from .core import Rearrange
-    r = Rearrange(use_numba=False) 
-    axis_sizes = r._determine_axis_sizes(tensor.shape, input_spec, axes_lengths)
-
-    intermediate_shape = []
-    input_axis_order = []
-    shape_iter = iter(tensor.shape)
-    ellipsis_dims = 0
-
-    for item in input_spec:
-        if item == '...':
-            ellipsis_dims = len(tensor.shape) - (len(input_spec) - 1)
-            intermediate_shape.extend(tensor.shape[:ellipsis_dims])
-            input_axis_order.extend([f'batch_{j}' for j in range(ellipsis_dims)])
-        elif item == '1':
-            size = next(shape_iter)
-            if size != 1:
-                raise ValueError(f"Expected singleton axis, got size {size}")
-            new_size = axes_lengths[output_spec[input_spec.index(item)]]
-            intermediate_shape.append(new_size)  
-            input_axis_order.append(output_spec[input_spec.index(item)])
-        elif isinstance(item, tuple):
-            group_size = next(shape_iter)
-            group_axes = list(item)
-            intermediate_shape.extend(axes_lengths[ax] for ax in group_axes)
-            input_axis_order.extend(group_axes)
-        else:
-            size = next(shape_iter)
-            intermediate_shape.append(size)
-            input_axis_order.append(item)
-
-    tensor = tensor.reshape(intermediate_shape)
-
-    output_axis_order = []
-    for item in output_spec:
-        if item == '...':
-            output_axis_order.extend([f'batch_{j}' for j in range(ellipsis_dims)])
-        elif isinstance(item, tuple):
-            output_axis_order.extend(item)
-        else:
-            output_axis_order.append(item)
+@nb.njit(parallel=True, cache=True)
+def transpose_kernel(src, dst, out_shape, src_strides, origin, a, b, block):
+    # dst is the C-ordered output, src_strides are signed element strides of the source for each
+    # output axis and `origin` the offset of its first element in src. The output is walked in
+    # block x block tiles over axes a (innermost output axis) and b (the axis the source is
+    # densest along), every other axis is an outer loop.
+    n = out_shape.shape[0]
+    dst_strides = np.empty(n, dtype=np.int64)
+    acc = 1
+    for ax in range(n - 1, -1, -1):
+        dst_strides[ax] = acc
+        acc *= out_shape[ax]
+    size_a = out_shape[a]
+    size_b = out_shape[b]
+    tiles_a = (size_a + block - 1) // block
+    tiles_b = (size_b + block - 1) // block
+    outer = 1
+    for ax in range(n):
+        if ax != a and ax != b:
+            outer *= out_shape[ax]
+    src_a = src_strides[a]
+    src_b = src_strides[b]
+    dst_b = dst_strides[b]
+    for t in nb.prange(outer * tiles_a * tiles_b):
+        ta = t % tiles_a
+        rem = t // tiles_a
+        tb = rem % tiles_b
+        rem //= tiles_b
+        src_off = origin
+        dst_off = 0
+        for ax in range(n - 1, -1, -1):
+            if ax == a or ax == b:
+                continue
+            i = rem % out_shape[ax]
+            rem //= out_shape[ax]
+            src_off += i * src_strides[ax]
+            dst_off += i * dst_strides[ax]
+        a0 = ta * block
+        a1 = min(a0 + block, size_a)
+        b0 = tb * block
+        b1 = min(b0 + block, size_b)
+        for j in range(b0, b1):
+            s = src_off + j * src_b
+            d = dst_off + j * dst_b
+            for i in range(a0, a1):
+                dst[d + i] = src[s + i * src_a]
+
+@nb.njit(parallel=True, cache=True)
+def transpose2d_kernel(src, dst, rows, cols, block):
+    tiles_r = (rows + block - 1) // block
+    tiles_c = (cols + block - 1) // block
+    for t in nb.prange(tiles_r * tiles_c):
+        r0 = (t // tiles_c) * block
+        c0 = (t % tiles_c) * block
+        r1 = min(r0 + block, rows)
+        c1 = min(c0 + block, cols)
+        for c in range(c0, c1):
+            for r in range(r0, r1):
+                dst[c * rows + r] = src[r * cols + c]
+
+def flat_source(tensor: np.ndarray):
+    # A 1-d view over all the memory `tensor` spans, its signed element strides and the offset
+    # of tensor[0, ..., 0] in that view; None when a stride is not a whole number of elements.
+    itemsize = tensor.itemsize
+    if any(s % itemsize for s in tensor.strides):
+        return None
+    strides = [s // itemsize for s in tensor.strides]
+    origin = sum((n - 1) * -s for n, s in zip(tensor.shape, strides) if s < 0)
+    span = 1 + sum((n - 1) * abs(s) for n, s in zip(tensor.shape, strides))
+    lowest = tensor[tuple(slice(None, None, -1) if s < 0 else slice(None) for s in strides)]
+    return np.lib.stride_tricks.as_strided(lowest, (span,), (itemsize,)), strides, origin
+
+def transpose_numba(tensor: np.ndarray, perm, out: np.ndarray = None) -> np.ndarray:
+    out_shape = tuple(tensor.shape[p] for p in perm)
+    if out is not None:
+        out = open_output(out, out_shape, tensor.dtype)
+    if not movable(tensor.dtype) or len(perm) < 2 or tensor.size == 0 or \
+            (out is not None and not out.flags.c_contiguous):
+        if out is None:
+            return np.transpose(tensor, perm).copy()
+        np.copyto(out, np.transpose(tensor, perm))
+        return out
+    if out is None:
+        out = np.empty(out_shape, dtype=tensor.dtype)
+    # the kernels only move words, so one compilation per item size serves every dtype
+    word = word_dtype(tensor, out)
+    src_words, dst_words = tensor.view(word), out.view(word)
+    block = 32 if word.itemsize <= 4 else 16
+    if tuple(perm) == (1, 0) and src_words.flags.c_contiguous:
+        transpose2d_kernel(src_words.reshape(-1), dst_words.reshape(-1), tensor.shape[0], tensor.shape[1], block)
+        return out
+    source = flat_source(src_words)
+    if source is None:
+        source = flat_source(np.ascontiguousarray(src_words))
+    src, strides, origin = source
+    src_strides = np.array([strides[p] for p in perm], dtype=np.int64)
+    # tiles run along the innermost output axis and the axis the source is densest along
+    a = len(perm) - 1
+    b = min((ax for ax in range(a) if out_shape[ax] > 1), key=lambda ax: abs(src_strides[ax]), default=0)
+    transpose_kernel(src, dst_words.reshape(-1), np.array(out_shape, dtype=np.int64), src_strides, origin, a, b,
+                     block)
+    return out
+
+inplace_kernel = nb.njit(cache=True)(follow_cycles)
+
+REDUCE_OPS = {'sum': 0, 'mean': 0, 'prod': 1, 'max': 2, 'min': 3}
 
-    perm = np.array([input_axis_order.index(ax) for ax in output_axis_order], dtype=np.int32)
-    out_shape = tuple(intermediate_shape[p] for p in perm)
+# sums add PAIRWISE_BLOCK elements at a time and combine the blocks pairwise, as NumPy does
+PAIRWISE_BLOCK = 128
 
-    out = np.empty(out_shape, dtype=tensor.dtype)
-    rearrange_numba_kernel(tensor, out, perm, tuple(intermediate_shape), out_shape)
+@nb.njit(cache=True, fastmath={'reassoc'})
+def reduce_window(src, base, starts, run, run_stride, op, sums, sizes):
+    # one output element from the window of src at `base`: a run of `run` elements `run_stride`
+    # apart at every offset in `starts`; sums and sizes are scratch for the pairwise levels
+    m = starts.shape[0]
+    if op == 0:
+        # a block is several short runs or a piece of a long one
+        per = max(PAIRWISE_BLOCK // run, 1)
+        top = 0
+        for j0 in range(0, m, per):
+            for k0 in range(0, run, PAIRWISE_BLOCK):
+                n = min(PAIRWISE_BLOCK, run - k0)
+                value = sums[0] - sums[0]
+                for j in range(j0, min(j0 + per, m)):
+                    p = base + starts[j] + k0 * run_stride
+                    if run_stride == 1:
+                        for k in range(n):
+                            value += src[p + k]
+                    else:
+                        for k in range(n):
+                            value += src[p + k * run_stride]
+                size = 1
+                while top > 0 and sizes[top - 1] == size:
+                    top -= 1
+                    value = sums[top] + value
+                    size *= 2
+                sums[top] = value
+                sizes[top] = size
+                top += 1
+        for t in range(top - 2, -1, -1):
+            sums[t] += sums[t + 1]
+        return sums[0]
+    sums[0] = src[base + starts[0]]
+    value = sums[0]
+    for j in range(m):
+        p = base + starts[j]
+        for k in range(run):
+            v = src[p + k * run_stride]
+            if op == 1:
+                if j > 0 or k > 0:
+                    value *= v
+            elif op == 2:
+                if v > value or v != v:
+                    value = v
+            elif v < value or v != v:
+                value = v
+    return value
 
-    final_shape = []
-    for item in output_spec:
-        if item == '...':
-            final_shape.extend(out_shape[:ellipsis_dims])
-        elif isinstance(item, tuple):
-            size = np.prod([axis_sizes[ax] for ax in item])
-            final_shape.append(size)
+@nb.njit(cache=True)
+def reduce_columns(src, base, step, width, starts, run, run_stride, op, levels, sizes):
+    # `width` output elements `step` apart in src, reduced one window element at a time so that
+    # every step reads a run of the kept axis; the result ends up in levels[0, :width]
+    m = starts.shape[0]
+    if op == 0:
+        per = max(PAIRWISE_BLOCK // run, 1)
+        top = 0
+        for j0 in range(0, m, per):
+            for k0 in range(0, run, PAIRWISE_BLOCK):
+                current = levels[top]
+                current[:width] = 0
+                for j in range(j0, min(j0 + per, m)):
+                    for k in range(k0, min(k0 + PAIRWISE_BLOCK, run)):
+                        row = base + starts[j] + k * run_stride
+                        if step == 1:
+                            for c in range(width):
+                                current[c] += src[row + c]
+                        else:
+                            for c in range(width):
+                                current[c] += src[row + c * step]
+                size = 1
+                while top > 0 and sizes[top - 1] == size:
+                    top -= 1
+                    for c in range(width):
+                        levels[top, c] += current[c]
+                    current = levels[top]
+                    size *= 2
+                sizes[top] = size
+                top += 1
+        for t in range(top - 2, -1, -1):
+            for c in range(width):
+                levels[t, c] += levels[t + 1, c]
+        return
+    current = levels[0]
+    for c in range(width):
+        current[c] = src[base + starts[0] + c * step]
+    for j in range(m):
+        for k in range(run):
+            if j == 0 and k == 0:
+                continue
+            row = base + starts[j] + k * run_stride
+            for c in range(width):
+                v = src[row + c * step]
+                if op == 1:
+                    current[c] *= v
+                elif op == 2:
+                    if v > current[c] or v != v:
+                        current[c] = v
+                elif v < current[c] or v != v:
+                    current[c] = v
+
+@nb.njit(parallel=True, cache=True)
+def reduce_kernel(src, dst, kept_shape, kept_strides, starts, run, run_stride, origin, op, chunk, by_window,
+                  depth, acc):
+    # dst[i] reduces the window (`starts`, `run`, `run_stride`) of src anchored at the source offset
+    # of output element i, counted from `origin`. Runs of `chunk` elements of the innermost kept
+    # axis are spread over threads; with `by_window` each element reads its own window (the
+    # window is the denser one), otherwise a run is reduced window element by window element.
+    # `depth` bounds the pairwise levels and `acc` only carries the accumulator dtype.
+    nk = kept_shape.shape[0]
+    inner = kept_shape[nk - 1]
+    inner_stride = kept_strides[nk - 1]
+    divisors = np.empty(nk, dtype=np.int64)
+    total = 1
+    for ax in range(nk - 2, -1, -1):
+        divisors[ax] = total
+        total *= kept_shape[ax]
+    tasks = (inner + chunk - 1) // chunk
+    for t in nb.prange(dst.shape[0] // inner * tasks):
+        r = t // tasks
+        c0 = t % tasks * chunk
+        width = min(chunk, inner - c0)
+        base = origin + c0 * inner_stride
+        for ax in range(nk - 1):
+            base += (r // divisors[ax] % kept_shape[ax]) * kept_strides[ax]
+        sizes = np.empty(depth, dtype=np.int64)
+        out = r * inner + c0
+        if by_window:
+            sums = np.zeros(depth, dtype=acc.dtype)
+            for c in range(width):
+                dst[out + c] = reduce_window(src, base + c * inner_stride, starts, run, run_stride, op, sums, sizes)
         else:
-            final_shape.append(axis_sizes[item])
+            levels = np.empty((depth, width), dtype=acc.dtype)
+            reduce_columns(src, base, inner_stride, width, starts, run, run_stride, op, levels, sizes)
+            for c in range(width):
+                dst[out + c] = levels[0, c]
+
+def reduce_numba(tensor: np.ndarray, recipe, reduction: str) -> np.ndarray:
+    source = flat_source(tensor)
+    if source is None:
+        tensor = np.ascontiguousarray(tensor)
+        source = flat_source(tensor)
+    src, strides, origin = source
+    inter = recipe.intermediate_shape
+    kept_shape, kept_strides, starts, run, run_stride = reduce_layout(
+        recipe, reshape_strides(tensor.shape, strides, inter))
+    dst = np.empty(math.prod(recipe.final_shape), dtype=result_dtype(reduction, tensor.dtype))
+    # each element reads its own window when the window is denser than the innermost kept axis
+    by_window = abs(run_stride) < abs(kept_strides[-1]) or kept_shape[-1] == 1
+    tasks = nb.get_num_threads() * 4
+    chunk = min(int(kept_shape[-1]), max(1 if by_window else 64, -(-dst.size // tasks)), 1024)
+    per = max(PAIRWISE_BLOCK // run, 1)
+    blocks = -(-len(starts) // per) * -(-run // PAIRWISE_BLOCK)
+    acc = np.zeros(1, dtype=accumulator_dtype(reduction, tensor.dtype))
+    reduce_kernel(src, dst, kept_shape, kept_strides, starts, run, run_stride, origin, REDUCE_OPS[reduction], chunk,
+                  by_window, blocks.bit_length() + 1, acc)
+    if reduction == 'mean':
+        dst /= len(starts) * run
+    return dst.reshape(recipe.final_shape)
+
+# dtypes compiled when this module is first imported; others compile on first use or in precompile().
+# Transposes compile once per item size, so these also cover int32, int64, complex64, ...
+EAGER_DTYPES = (np.float32, np.float64)
+
+def _signatures(dtype: np.dtype):
+    word = word_dtype(np.empty(1, dtype=dtype))
+    words = nb.from_dtype(word)[::1]
+    index = nb.int64[::1]
+    yield transpose_kernel, (words, words, index, index, nb.int64, nb.int64, nb.int64, nb.int64)
+    yield transpose2d_kernel, (words, words, nb.int64, nb.int64, nb.int64)
+    if dtype.kind in 'iuf':
+        array = nb.from_dtype(dtype)[::1]
+        for reduction in REDUCE_OPS:
+            result = nb.from_dtype(result_dtype(reduction, dtype))[::1]
+            acc = nb.from_dtype(accumulator_dtype(reduction, dtype))[::1]
+            yield reduce_kernel, (array, result, index, index, index, nb.int64, nb.int64, nb.int64, nb.int64,
+                                  nb.int64, nb.boolean, nb.int64, acc)
+
+def precompile(dtypes) -> None:
+    # loads the kernels from the on-disk cache when an earlier process already compiled them
+    for dtype in dtypes:
+        dtype = np.dtype(dtype)
+        if not movable(dtype):
+            continue
+        for kernel, signature in _signatures(dtype):
+            kernel.compile(signature)
+
+def rearrange_numba(tensor: np.ndarray, input_spec: list, output_spec: list,
+                    axes_lengths: dict) -> np.ndarray:
+    from .core import Rearrange
+    r = Rearrange(use_numba=True)
+    recipe = r._build_recipe(tensor.shape, input_spec, output_spec, axes_lengths)
+    return r._execute(tensor, recipe)
 
-    return out.reshape(final_shape)
\ No newline at end of file
+precompile(EAGER_DTYPES)
@@ -0,0 +1,68 @@
+from typing import Sequence, Tuple
+
+IDENTITY = 'identity'
+TRANSPOSE_2D = 'transpose2d'
+GENERAL = 'general'
+
+
+def coalesce_axes(shape: Sequence[int], perm: Sequence[int]) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    # Drops size-1 axes and merges runs of axes that are adjacent and in the same order in
+    # both the input and the permuted output, so the transpose runs at the lowest rank.
+    nonunit = [i for i in range(len(shape)) if shape[i] != 1]
+    rank = {axis: k for k, axis in enumerate(nonunit)}
+    sizes = [shape[i] for i in nonunit]
+    order = [rank[p] for p in perm if shape[p] != 1]
+    if not order:
+        return (), ()
+    runs = [[order[0]]]
+    for p in order[1:]:
+        if p == runs[-1][-1] + 1:
+            runs[-1].append(p)
+        else:
+            runs.append([p])
+    by_input = sorted(range(len(runs)), key=lambda r: runs[r][0])
+    reduced_shape = []
+    for r in by_input:
+        size = 1
+        for p in runs[r]:
+            size *= sizes[p]
+        reduced_shape.append(size)
+    position = {r: i for i, r in enumerate(by_input)}
+    reduced_perm = tuple(position[r] for r in range(len(runs)))
+    return tuple(reduced_shape), reduced_perm
+
+
+def coalesce_strided(shape: Sequence[int], strides: Sequence[int], perm: Sequence[int]) \
+        -> Tuple[Tuple[int, ...], Tuple[int, ...], Tuple[int, ...]]:
+    # coalesce_axes for a strided input: a run only grows where the next axis is also the next
+    # one in memory, so each merged axis keeps a single stride and the input needs no copy.
+    nonunit = [i for i in range(len(shape)) if shape[i] != 1]
+    following = dict(zip(nonunit, nonunit[1:]))
+    order = [p for p in perm if shape[p] != 1]
+    if not order:
+        return (), (), ()
+    runs = [[order[0]]]
+    for p in order[1:]:
+        q = runs[-1][-1]
+        if following.get(q) == p and strides[q] == shape[p] * strides[p]:
+            runs[-1].append(p)
+        else:
+            runs.append([p])
+    by_input = sorted(range(len(runs)), key=lambda r: runs[r][0])
+    new_shape, new_strides = [], []
+    for r in by_input:
+        size = 1
+        for p in runs[r]:
+            size *= shape[p]
+        new_shape.append(size)
+        new_strides.append(strides[runs[r][-1]])
+    position = {r: i for i, r in enumerate(by_input)}
+    return tuple(new_shape), tuple(new_strides), tuple(position[r] for r in range(len(runs)))
+
+
+def classify(perm: Sequence[int]) -> str:
+    if len(perm) <= 1:
+        return IDENTITY
+    if len(perm) == 2:
+        return TRANSPOSE_2D
+    return GENERAL
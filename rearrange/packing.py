@@ -0,0 +1,88 @@
+import math
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from . import parallel
+from .parser import ParserError, PatternParser
+from .plan import reshape_view
+
+
+def parse_pack(parser: PatternParser, pattern: str) -> Tuple[int, int]:
+    # (axes before '*', axes after '*') of a pack pattern such as 'b * c'
+    tokens = parser.tokenize(pattern)
+    if tokens.count('*') != 1:
+        raise ParserError(f"Pack pattern must contain exactly one '*', got '{pattern}'")
+    for token in tokens:
+        if token != '*' and (not isinstance(token, str) or not token.isidentifier()):
+            raise ParserError(f"Pack pattern may only contain axis names and '*', got {token!r}")
+    if len(set(tokens)) != len(tokens):
+        raise ParserError("Repeated dimension name")
+    star = tokens.index('*')
+    return star, len(tokens) - star - 1
+
+
+def _split(shape: Tuple[int, ...], before: int, after: int, k: int) -> Tuple[tuple, tuple, tuple]:
+    if len(shape) < before + after:
+        raise ValueError(f"Array {k} of shape {shape} has fewer than the {before + after} named axes of the pattern")
+    return shape[:before], shape[before:len(shape) - after], shape[len(shape) - after:]
+
+
+def pack(tensors: Sequence[np.ndarray], before: int, after: int,
+         workers: Optional[int] = None) -> Tuple[np.ndarray, List[Tuple[int, ...]]]:
+    # All destination offsets are fixed up front, then every input is copied straight into its
+    # slice of one output; splitting that slice back to the input's shape is always a view.
+    tensors = [np.asarray(t) for t in tensors]
+    if not tensors:
+        raise ValueError("pack needs at least one array")
+    parts = [_split(t.shape, before, after, k) for k, t in enumerate(tensors)]
+    outer, _, inner = parts[0]
+    for k, (pre, _, post) in enumerate(parts):
+        if pre != outer or post != inner:
+            raise ValueError(f"Array {k} has named axes {pre + post}, expected {outer + inner} "
+                             f"as for array 0")
+    shapes = [star for _, star, _ in parts]
+    offsets = np.cumsum([0] + [math.prod(star) for star in shapes]).tolist()
+    out = np.empty(outer + (offsets[-1],) + inner, dtype=np.result_type(*tensors))
+    tasks = []
+    for tensor, start, stop in zip(tensors, offsets, offsets[1:]):
+        dst = out[(slice(None),) * before + (slice(start, stop),)]
+        # merged when the input allows it, since fewer and longer rows copy faster
+        src = reshape_view(tensor, dst.shape)
+        if src is None:
+            src, dst = tensor, reshape_view(dst, tensor.shape)
+        tasks.append((dst, src))
+    workers = workers or parallel.get_workers()
+    if workers <= 1 or out.nbytes < parallel.PARALLEL_MIN_BYTES or len(tasks) == 1:
+        for dst, tensor in tasks:
+            np.copyto(dst, tensor)
+    else:
+        parallel.map_tasks(workers, lambda task: np.copyto(*task), tasks)
+    return out, shapes
+
+
+def unpack(tensor: np.ndarray, shapes: Sequence[Sequence[int]], before: int, after: int) -> List[np.ndarray]:
+    # Views of `tensor`, one per entry of `shapes`; a single entry may hold one -1.
+    if tensor.ndim != before + after + 1:
+        raise ValueError(f"Expected an array with {before + after + 1} dimensions, got shape {tensor.shape}")
+    shapes = [tuple(int(s) for s in shape) for shape in shapes]
+    unknown = [k for k, shape in enumerate(shapes) if -1 in shape]
+    total = tensor.shape[before]
+    if len(unknown) > 1 or any(shape.count(-1) > 1 for shape in shapes):
+        raise ValueError("Only one unpacked shape may contain -1, and only once")
+    known = sum(math.prod(shape) for k, shape in enumerate(shapes) if k not in unknown)
+    if unknown:
+        k = unknown[0]
+        rest = -math.prod(shapes[k])
+        if total < known or rest == 0 or (total - known) % rest:
+            raise ValueError(f"Cannot infer -1 in {shapes[k]}: {total - known} elements left")
+        shapes[k] = tuple((total - known) // rest if s == -1 else s for s in shapes[k])
+    elif known != total:
+        raise ValueError(f"Shapes {shapes} hold {known} elements, the packed axis has {total}")
+    pre, post = tensor.shape[:before], tensor.shape[before + 1:]
+    views, start = [], 0
+    for shape in shapes:
+        stop = start + math.prod(shape)
+        views.append(reshape_view(tensor[(slice(None),) * before + (slice(start, stop),)], pre + shape + post))
+        start = stop
+    return views
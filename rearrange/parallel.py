@@ -0,0 +1,75 @@
+import importlib.util
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# below this many output bytes a thread hand-off costs more than the copy itself
+PARALLEL_MIN_BYTES = 1 << 22
+
+_workers = 1
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_size = 0
+_lock = threading.Lock()
+
+
+def set_workers(workers: Optional[int]) -> None:
+    global _workers
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError(f"workers must be at least 1, got {workers}")
+    _workers = workers
+    # the Eigen transpose runs on its own thread pool, so keep it at the same size
+    if importlib.util.find_spec(f'{__package__}.eigen_backend') is not None:
+        from .eigen_backend_wrapper import set_num_threads
+        set_num_threads(workers)
+
+
+def get_workers() -> int:
+    return _workers
+
+
+def _executor_for(workers: int) -> ThreadPoolExecutor:
+    global _executor, _executor_size
+    with _lock:
+        if _executor is None or _executor_size < workers:
+            # no shutdown: other threads may still be mapping on the old pool, whose threads exit
+            # once it is garbage collected
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rearrange')
+            _executor_size = workers
+        return _executor
+
+
+def map_tasks(workers: int, fn: Callable, tasks: Iterable) -> list:
+    # fn applied to every task on the shared pool, results in task order
+    return list(_executor_for(workers).map(fn, tasks))
+
+
+def slabs(shape: Tuple[int, ...], parts: int) -> List[tuple]:
+    # Index tuples splitting the outermost axes into about `parts` disjoint slabs.
+    outer = 1
+    for k, size in enumerate(shape):
+        if outer * size >= parts:
+            pieces = math.ceil(parts / outer)
+            step = math.ceil(size / pieces)
+            return [idx + (slice(start, min(start + step, size)),)
+                    for idx in np.ndindex(*shape[:k]) for start in range(0, size, step)]
+        outer *= size
+    return [()]
+
+
+def copyto(dst: np.ndarray, src: np.ndarray, workers: Optional[int] = None) -> None:
+    workers = workers or _workers
+    if workers <= 1 or dst.nbytes < PARALLEL_MIN_BYTES:
+        np.copyto(dst, src)
+        return
+    tasks = slabs(dst.shape, workers)
+    if len(tasks) <= 1:
+        np.copyto(dst, src)
+        return
+    # np.copyto releases the GIL for plain dtypes, so the slabs are filled concurrently
+    map_tasks(workers, lambda idx: np.copyto(dst[idx], src[idx]), tasks)
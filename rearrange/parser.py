@@ -3,6 +3,13 @@ from typing import List, Set, Tuple, Union
 class ParserError(Exception):
     pass
 
+def as_value_error(e: Exception) -> ValueError:
+    if isinstance(e, ParserError):
+        return ValueError(f"Pattern parsing error: {str(e)}")
+    if "Repeated dimension name" in str(e):
+        return ValueError("Repeated dimension name")
+    return ValueError(str(e))
+
 class PatternParser:
     def tokenize(self, pattern: str) -> List[Union[str, Tuple[str, ...]]]:
         tokens = []
@@ -0,0 +1,239 @@
+import math
+import time
+import numpy as np
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from . import instrument
+from .cache import axes_key
+from .parser import as_value_error
+
+
+def reshape_strides(shape: Tuple[int, ...], strides: Tuple[int, ...], new_shape: Tuple[int, ...],
+                    itemsize: int = 1) -> Optional[Tuple[int, ...]]:
+    # Mirrors numpy's _attempt_nocopy_reshape: strides of the reshaped view, or None when
+    # the reshape has to copy.
+    new_shape = tuple(new_shape)
+    if 0 in shape or 0 in new_shape:
+        return (0,) * len(new_shape)
+    old_dims = [d for d in shape if d != 1]
+    old_strides = [s for d, s in zip(shape, strides) if d != 1]
+    new_strides = [0] * len(new_shape)
+    oi, oj, ni, nj = 0, 1, 0, 1
+    while ni < len(new_shape) and oi < len(old_dims):
+        np_ = new_shape[ni]
+        op = old_dims[oi]
+        while np_ != op:
+            if np_ < op:
+                np_ *= new_shape[nj]
+                nj += 1
+            else:
+                op *= old_dims[oj]
+                oj += 1
+        for ok in range(oi, oj - 1):
+            if old_strides[ok] != old_dims[ok + 1] * old_strides[ok + 1]:
+                return None
+        new_strides[nj - 1] = old_strides[oj - 1]
+        for nk in range(nj - 1, ni, -1):
+            new_strides[nk - 1] = new_strides[nk] * new_shape[nk]
+        ni, nj = nj, nj + 1
+        oi, oj = oj, oj + 1
+    last_stride = new_strides[ni - 1] if ni >= 1 else itemsize
+    for nk in range(ni, len(new_shape)):
+        new_strides[nk] = last_stride
+    return tuple(new_strides)
+
+
+def reshape_view(tensor: np.ndarray, new_shape: Tuple[int, ...]) -> Optional[np.ndarray]:
+    strides = reshape_strides(tensor.shape, tensor.strides, new_shape, tensor.itemsize)
+    if strides is None:
+        return None
+    return np.lib.stride_tricks.as_strided(tensor, tuple(new_shape), strides)
+
+
+# Rearranging only moves bytes, so the compiled kernels see every item as unsigned words.
+# 16-byte items travel as a pair of 8-byte words and only need 8-byte alignment.
+WORD_DTYPES = {1: np.dtype(np.uint8), 2: np.dtype(np.uint16), 4: np.dtype(np.uint32), 8: np.dtype(np.uint64),
+               16: np.dtype([('lo', np.uint64), ('hi', np.uint64)])}
+
+
+def movable(dtype: np.dtype) -> bool:
+    return not dtype.hasobject and dtype.itemsize > 0
+
+
+@lru_cache(maxsize=None)
+def _record(itemsize: int, size: int) -> np.dtype:
+    if itemsize == size:
+        return WORD_DTYPES[size]
+    return np.dtype([(f'w{i}', WORD_DTYPES[size]) for i in range(itemsize // size)])
+
+
+def word_dtype(*arrays: np.ndarray) -> np.dtype:
+    # A dtype of the same item size built from the widest word that divides it and keeps every
+    # array aligned; item sizes that are not a word become a record of words.
+    itemsize = arrays[0].itemsize
+    sizes = [itemsize] if itemsize in WORD_DTYPES else []
+    for size in sizes + [8, 4, 2, 1]:
+        align = min(size, 8)
+        if itemsize % size == 0 and all(a.ctypes.data % align == 0 and all(s % align == 0 for s in a.strides)
+                                        for a in arrays):
+            return _record(itemsize, size)
+    return _record(itemsize, 1)
+
+
+def recipe_strides(recipe, shape: Tuple[int, ...], strides: Tuple[int, ...],
+                   itemsize: int = 1) -> Optional[Tuple[int, ...]]:
+    shape, strides = tuple(shape), tuple(strides)
+    if recipe.drop_index is not None:
+        kept = [i for i, index in enumerate(recipe.drop_index) if not isinstance(index, int)]
+        shape = tuple(shape[i] for i in kept)
+        strides = tuple(strides[i] for i in kept)
+    strides = reshape_strides(shape, strides, recipe.intermediate_shape, itemsize)
+    if strides is None:
+        return None
+    shape = tuple(recipe.intermediate_shape[i] for i in recipe.perm)
+    strides = tuple(strides[i] for i in recipe.perm)
+    return reshape_strides(shape, strides, recipe.final_shape, itemsize)
+
+
+def group_labels(output_spec, ndim: int) -> List[str]:
+    # one label per output dimension, as written in the pattern
+    labels = []
+    for token in output_spec:
+        if token == '...':
+            labels.extend(['...'] * (ndim - len(output_spec) + 1))
+        elif isinstance(token, tuple):
+            labels.append('(' + ' '.join(token) + ')')
+        else:
+            labels.append(token)
+    return labels
+
+
+def _view_blocker(recipe, shape: Tuple[int, ...], strides: Tuple[int, ...], itemsize: int, output_spec) -> str:
+    if recipe.drop_index is not None:
+        kept = [i for i, index in enumerate(recipe.drop_index) if not isinstance(index, int)]
+        shape = tuple(shape[i] for i in kept)
+        strides = tuple(strides[i] for i in kept)
+    inter = reshape_strides(shape, strides, recipe.intermediate_shape, itemsize)
+    if inter is None:
+        return f"the input strides {strides} cannot be split into {recipe.intermediate_shape}"
+    axes = [(recipe.intermediate_shape[p], inter[p]) for p in recipe.perm]
+    label = unmergeable_group(axes, recipe.final_shape, output_spec)
+    if label is not None:
+        return f"output group {label} merges axes that are not contiguous in memory"
+    return f"the input strides {strides} do not allow it"
+
+
+def unmergeable_group(axes: List[Tuple[int, int]], final_shape: Tuple[int, ...], output_spec) -> Optional[str]:
+    # label of the first output dimension whose (size, stride) axes cannot be merged into one stride
+    axes = [axis for axis in axes if axis[0] != 1]
+    k = 0
+    for label, size in zip(group_labels(output_spec, len(final_shape)), final_shape):
+        if size == 1:
+            continue
+        run = [axes[k]]
+        k += 1
+        while math.prod(n for n, _ in run) < size:
+            run.append(axes[k])
+            k += 1
+        if any(outer != n * inner for (_, outer), (n, inner) in zip(run, run[1:])):
+            return label
+    return None
+
+
+def strided_view(tensor: np.ndarray, recipe, output_spec) -> np.ndarray:
+    strides = recipe_strides(recipe, tensor.shape, tensor.strides, tensor.itemsize)
+    if strides is None:
+        reason = _view_blocker(recipe, tensor.shape, tensor.strides, tensor.itemsize, output_spec)
+        raise ValueError(f"Cannot rearrange without a copy: {reason}")
+    return np.lib.stride_tricks.as_strided(tensor, recipe.final_shape, strides,
+                                           writeable=tensor.flags.writeable)
+
+
+class RearrangePlan:
+    __slots__ = ('pattern', 'input_spec', 'output_spec', 'axes_lengths', 'backend', 'shape', 'recipe',
+                 '_planner', '_key')
+
+    def __init__(self, planner, pattern: str, input_spec: list, output_spec: list,
+                 axes_lengths: Dict[str, int], shape: Optional[Tuple[int, ...]] = None, recipe=None):
+        set_ = object.__setattr__
+        set_(self, 'pattern', pattern)
+        set_(self, 'input_spec', tuple(input_spec))
+        set_(self, 'output_spec', tuple(output_spec))
+        set_(self, 'axes_lengths', dict(axes_lengths))
+        set_(self, 'backend', planner.backend_name)
+        set_(self, 'shape', shape)
+        set_(self, 'recipe', recipe)
+        set_(self, '_planner', planner)
+        set_(self, '_key', axes_key(axes_lengths))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RearrangePlan is immutable")
+
+    def __repr__(self) -> str:
+        shape = '' if self.shape is None else f', shape={self.shape}'
+        return f"RearrangePlan({self.pattern!r}, backend={self.backend!r}{shape})"
+
+    def resolve(self, shape: Tuple[int, ...]):
+        shape = tuple(shape)
+        if self.shape is not None:
+            if shape != self.shape:
+                raise ValueError(f"Plan is specialized for shape {self.shape}, got {shape}")
+            return self.recipe
+        try:
+            return self._planner.resolve(self.pattern, shape, None, self.axes_lengths, self._key,
+                                         (list(self.input_spec), list(self.output_spec)))
+        except Exception as e:
+            raise as_value_error(e)
+
+    def specialize(self, shape: Tuple[int, ...]) -> 'RearrangePlan':
+        recipe = self.resolve(shape)
+        return RearrangePlan(self._planner, self.pattern, self.input_spec, self.output_spec,
+                             self.axes_lengths, tuple(shape), recipe)
+
+    def output_shape(self, shape: Tuple[int, ...]) -> Tuple[int, ...]:
+        return self.resolve(shape).final_shape
+
+    def is_view(self, shape: Tuple[int, ...], strides: Tuple[int, ...]) -> bool:
+        return recipe_strides(self.resolve(shape), shape, strides) is not None
+
+    def backend_for(self, shape: Tuple[int, ...], strides: Tuple[int, ...], dtype) -> str:
+        # `backend` is what the plan was compiled with; under 'auto' this is the one a call with an
+        # array of this shape, byte strides and dtype runs on
+        return self._planner.backend_for(self.resolve(shape), tuple(shape), tuple(strides), dtype)
+
+    def __call__(self, tensor: np.ndarray, out=None, pool=None, copy: Optional[bool] = None,
+                 inplace: bool = False) -> np.ndarray:
+        if out is not None or pool is not None or copy is not None or inplace:
+            try:
+                if inplace:
+                    from .inplace import check_inplace_pattern
+                    check_inplace_pattern(self._planner.parser, list(self.input_spec), list(self.output_spec))
+                if instrument.enabled:
+                    return self._call_instrumented(tensor, out, pool, copy, inplace)
+                return self._run(tensor, self.resolve(tensor.shape), out, pool, copy, inplace)
+            except Exception as e:
+                raise as_value_error(e)
+        if instrument.enabled:
+            return self._call_instrumented(tensor)
+        recipe = self.recipe
+        if recipe is None or tensor.shape != self.shape:
+            recipe = self.resolve(tensor.shape)
+        return self._planner.execute(tensor, recipe)
+
+    def _run(self, tensor: np.ndarray, recipe, out=None, pool=None, copy: Optional[bool] = None,
+             inplace: bool = False) -> np.ndarray:
+        if out is None and pool is None and copy is None and not inplace:
+            return self._planner.execute(tensor, recipe)
+        return self._planner._execute_into(tensor, recipe, out, pool, copy=copy, output_spec=self.output_spec,
+                                           inplace=inplace)
+
+    def _call_instrumented(self, tensor: np.ndarray, out=None, pool=None, copy: Optional[bool] = None,
+                           inplace: bool = False) -> np.ndarray:
+        start = time.perf_counter()
+        recipe = self.resolve(tensor.shape)
+        planned = time.perf_counter()
+        result = self._run(tensor, recipe, out, pool, copy, inplace)
+        done = time.perf_counter()
+        instrument.observe(self.pattern, tensor, result, self._planner.selected_backend(tensor, recipe),
+                           0.0, planned - start, done - planned, out is None)
+        return result
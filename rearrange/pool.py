@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+PoolInfo = namedtuple('PoolInfo', ['hits', 'misses', 'leased', 'idle', 'idle_bytes', 'max_bytes'])
+
+
+class BufferPool:
+    def __init__(self, max_bytes: int = 1 << 28):
+        if max_bytes < 0:
+            raise ValueError(f"max_bytes must be non-negative, got {max_bytes}")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._idle: Dict[Tuple[tuple, np.dtype], List[np.ndarray]] = {}
+        # ids of idle buffers, least recently released first
+        self._order: 'OrderedDict[int, Tuple[tuple, np.dtype]]' = OrderedDict()
+        self._leased: Dict[int, np.ndarray] = {}
+        self._idle_bytes = 0
+        self._lock = threading.Lock()
+
+    def lease(self, shape: Tuple[int, ...], dtype) -> np.ndarray:
+        key = (tuple(int(s) for s in shape), np.dtype(dtype))
+        with self._lock:
+            buffers = self._idle.get(key)
+            if buffers:
+                array = buffers.pop()
+                del self._order[id(array)]
+                self._idle_bytes -= array.nbytes
+                self.hits += 1
+            else:
+                array = None
+                self.misses += 1
+        if array is None:
+            array = np.empty(key[0], dtype=key[1])
+        with self._lock:
+            self._leased[id(array)] = array
+        return array
+
+    def release(self, array: np.ndarray) -> bool:
+        # Arrays this pool did not lease (e.g. views returned instead of a copy) are ignored.
+        with self._lock:
+            if self._leased.pop(id(array), None) is None:
+                return False
+            if array.nbytes > self.max_bytes:
+                return True
+            key = (array.shape, array.dtype)
+            self._idle.setdefault(key, []).append(array)
+            self._order[id(array)] = key
+            self._idle_bytes += array.nbytes
+            self._evict(self.max_bytes)
+            return True
+
+    @contextmanager
+    def leased(self, shape: Tuple[int, ...], dtype) -> Iterator[np.ndarray]:
+        array = self.lease(shape, dtype)
+        try:
+            yield array
+        finally:
+            self.release(array)
+
+    def resize(self, max_bytes: int) -> None:
+        if max_bytes < 0:
+            raise ValueError(f"max_bytes must be non-negative, got {max_bytes}")
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict(max_bytes)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._evict(0)
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> PoolInfo:
+        with self._lock:
+            return PoolInfo(self.hits, self.misses, len(self._leased), len(self._order),
+                            self._idle_bytes, self.max_bytes)
+
+    def _evict(self, max_bytes: int) -> None:
+        while self._idle_bytes > max_bytes:
+            ident, key = self._order.popitem(last=False)
+            buffers = self._idle[key]
+            index = next(i for i, b in enumerate(buffers) if id(b) == ident)
+            self._idle_bytes -= buffers.pop(index).nbytes
+            if not buffers:
+                del self._idle[key]
@@ -0,0 +1,76 @@
+import math
+from functools import lru_cache
+from typing import Tuple
+
+import numpy as np
+
+REDUCTIONS = {'sum': np.sum, 'mean': np.mean, 'max': np.max, 'min': np.min, 'prod': np.prod}
+
+
+def check_reduction(reduction: str) -> None:
+    if reduction not in REDUCTIONS:
+        raise ValueError(f"Unknown reduction '{reduction}', expected one of {tuple(REDUCTIONS)}")
+
+
+@lru_cache(maxsize=None)
+def result_dtype(reduction: str, dtype: np.dtype) -> np.dtype:
+    return REDUCTIONS[reduction](np.zeros(1, dtype=dtype)).dtype
+
+
+def numba_reducible(dtype: np.dtype) -> bool:
+    # dtypes the compiled kernel reduces natively
+    return dtype.kind in 'iu' or dtype in (np.float32, np.float64)
+
+
+def accumulator_dtype(reduction: str, dtype: np.dtype) -> np.dtype:
+    # float sums and means accumulate in float64, so float32 loses no accuracy against NumPy
+    result = result_dtype(reduction, dtype)
+    if reduction in ('sum', 'mean') and result.kind == 'f':
+        return np.dtype(np.float64)
+    return result
+
+
+def kept_axes(recipe) -> Tuple[int, ...]:
+    return recipe.perm[:len(recipe.perm) - len(recipe.reduced_axes)]
+
+
+def reduce_numpy(tensor: np.ndarray, recipe, reduction: str) -> np.ndarray:
+    # reduce over the split (view) intermediate first, so only the smaller result is permuted
+    reduced = set(recipe.reduced_axes)
+    result = REDUCTIONS[reduction](tensor.reshape(recipe.intermediate_shape), axis=recipe.reduced_axes)
+    remaining = [ax for ax in range(len(recipe.intermediate_shape)) if ax not in reduced]
+    return np.transpose(result, [remaining.index(ax) for ax in kept_axes(recipe)]).reshape(recipe.final_shape)
+
+
+def reduce_layout(recipe, strides=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int, int]:
+    # Element strides of the split input (C-contiguous unless given) for the kept axes in output
+    # order, adjacent ones merged. A reduction window is read as runs along its densest axis:
+    # the offsets where each run starts, the run length and the stride within a run.
+    inter = recipe.intermediate_shape
+    if strides is None:
+        strides = [math.prod(inter[ax + 1:]) for ax in range(len(inter))]
+    shape, kept_strides = merge_axes([(inter[ax], strides[ax]) for ax in kept_axes(recipe)])
+    if not shape:
+        shape, kept_strides = [1], [0]
+    window = sorted(((inter[ax], strides[ax]) for ax in recipe.reduced_axes), key=lambda axis: -abs(axis[1]))
+    sizes, window_strides = merge_axes(window)
+    run, run_stride = (sizes.pop(), window_strides.pop()) if sizes else (1, 0)
+    starts = np.zeros(1, dtype=np.int64)
+    for size, stride in zip(sizes, window_strides):
+        starts = (starts[:, None] + np.arange(size, dtype=np.int64) * stride).reshape(-1)
+    return np.array(shape, dtype=np.int64), np.array(kept_strides, dtype=np.int64), starts, run, run_stride
+
+
+def merge_axes(axes) -> Tuple[list, list]:
+    # (size, stride) axes without the unit ones, neighbours that step evenly through memory merged
+    shape, strides = [], []
+    for size, stride in axes:
+        if size == 1:
+            continue
+        if shape and strides[-1] == size * stride:
+            shape[-1] *= size
+            strides[-1] = stride
+        else:
+            shape.append(size)
+            strides.append(stride)
+    return shape, strides
@@ -10,7 +10,8 @@ eigen_backend = Extension(
         '/usr/include/eigen3',
         pybind11.get_include(),
     ],
-    extra_compile_args=['-std=c++17', '-ftemplate-depth=2048'],
+    extra_compile_args=['-std=c++17', '-O3', '-pthread', '-ftemplate-depth=2048'],
+    extra_link_args=['-pthread'],
     language='c++'
 )
 
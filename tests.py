@@ -199,5 +199,901 @@ def test_large_dim_with_broadcast_singleton():
     assert np.all(result == 1)
 
 
+def test_plan_cache_hits_and_clear():
+    import rearrange as rr
+    rr.clear_cache()
+    x = np.random.rand(2, 12, 10)
+    first = rearrange(x, 'b (h w) c -> b c h w', h=3)
+    second = rearrange(x, 'b (h w) c -> b c h w', h=3)
+    info = rr.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 1, 1)
+    assert np.array_equal(first, second)
+    rearrange(x.astype(np.float32), 'b (h w) c -> b c h w', h=3)
+    rearrange(x, 'b (h w) c -> b c h w', h=4)
+    assert rr.cache_info().misses == 3
+    rr.clear_cache()
+    assert rr.cache_info() == (0, 0, info.maxsize, 0)
+
+def test_plan_cache_bounded_size():
+    import rearrange as rr
+    from rearrange.core import pattern_cache
+    rr.clear_cache()
+    rr.set_cache_size(2)
+    try:
+        for n in range(2, 6):
+            rearrange(np.zeros((n, 3)), 'a b -> b a')
+        assert rr.cache_info().currsize == 2
+        assert pattern_cache.maxsize == 2 and pattern_cache.info().currsize <= 2
+    finally:
+        rr.set_cache_size(1024)
+        pattern_cache.resize(128)
+        rr.clear_cache()
+
+def test_plan_cache_keys_numpy_axis_lengths():
+    import rearrange as rr
+    rr.clear_cache()
+    x = np.random.rand(12, 10)
+    expected = x.reshape(3, 4, 10)
+    for h in (np.array(3), np.int64(3), 3):
+        assert np.array_equal(rearrange(x, '(h w) c -> h w c', h=h), expected)
+        assert rr.reduce(x, '(h w) c -> h c', 'sum', h=h).shape == (3, 10)
+        assert rr.repeat(x, 'a b -> a b c', c=h).shape == (12, 10, 3)
+        assert np.array_equal(rr.compile('(h w) c -> h w c', h=h)(x), expected)
+    assert rr.cache_info().currsize == 4
+
+def test_plan_cache_does_not_store_errors():
+    import rearrange as rr
+    rr.clear_cache()
+    x = np.random.rand(12, 10)
+    for _ in range(2):
+        with pytest.raises(ValueError, match="Group size mismatch"):
+            rearrange(x, '(h w) c -> h w c', h=5, w=3)
+    assert rr.cache_info().currsize == 0
+
+def test_plan_cache_thread_safety():
+    import threading
+    x = np.random.rand(4, 6, 8)
+    expected = x.transpose(2, 0, 1)
+    errors = []
+    def worker():
+        for _ in range(200):
+            if not np.array_equal(rearrange(x, 'a b c -> c a b'), expected):
+                errors.append(1)
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+
+
+def test_compiled_plan_matches_rearrange():
+    import rearrange as rr
+    plan = rr.compile('b (h w) c -> b c h w', h=3)
+    for shape in [(2, 12, 10), (5, 6, 1)]:
+        x = np.random.rand(*shape)
+        assert np.array_equal(plan(x), rearrange(x, 'b (h w) c -> b c h w', h=3))
+    assert plan.output_shape((2, 12, 10)) == (2, 10, 3, 4)
+    assert plan.backend == 'numpy'
+
+def test_compiled_plan_is_immutable():
+    import rearrange as rr
+    plan = rr.compile('a b -> b a')
+    with pytest.raises(AttributeError):
+        plan.pattern = 'b a -> a b'
+    with pytest.raises(AttributeError):
+        plan.extra = 1
+
+def test_compiled_plan_specialized_shape():
+    import rearrange as rr
+    plan = rr.compile('a b c -> c (a b)').specialize((2, 3, 4))
+    x = np.random.rand(2, 3, 4)
+    assert np.array_equal(plan(x), x.transpose(2, 0, 1).reshape(4, 6))
+    with pytest.raises(ValueError, match="specialized for shape"):
+        plan(np.random.rand(2, 3, 5))
+
+def test_compiled_plan_errors():
+    import rearrange as rr
+    with pytest.raises(ValueError, match="Pattern parsing error"):
+        rr.compile('a b c')
+    plan = rr.compile('(h w) c -> h w c', h=5, w=3)
+    with pytest.raises(ValueError, match="Group size mismatch"):
+        plan(np.random.rand(12, 10))
+
+def test_compiled_plan_is_view_agrees_with_numpy():
+    import rearrange as rr
+    cases = [
+        ('a b c -> c (a b)', np.random.rand(2, 3, 4)),
+        ('a b c -> (a b) c', np.random.rand(2, 3, 4)),
+        ('a b c -> (a b) c', np.random.rand(2, 6, 4)[:, ::2]),
+        ('a b c -> a (b c)', np.random.rand(2, 3, 8)[:, :, ::2]),
+        ('(h w) c -> c h w', np.random.rand(12, 5)),
+        ('h w c -> c (w h)', np.ones((3, 4, 5))[:, ::2, :]),
+    ]
+    for pattern, x in cases:
+        plan = rr.compile(pattern, h=3) if 'h w)' in pattern else rr.compile(pattern)
+        assert plan.is_view(x.shape, x.strides) == np.shares_memory(plan(x), x), pattern
+
+def test_compiled_plan_backend_for_each_layout(tmp_path):
+    import rearrange as rr
+    from rearrange import dispatch
+    dispatch.load_profile(str(tmp_path / 'missing.json'))
+    plan = rr.compile('a b c -> (c a) b', backend='auto')
+    assert plan.backend == 'auto'
+    big = np.empty((64, 128, 96), dtype=np.float32)
+    expected = dispatch.select_backend(plan.resolve(big.shape), big.dtype)
+    assert plan.backend_for(big.shape, big.strides, big.dtype) == expected
+    with rr.instrument.recording() as calls:
+        plan(big)
+    assert calls[0].backend == expected
+    assert plan.backend_for((2, 3, 4), (48, 16, 4), np.float32) == 'numpy'
+    assert rr.compile('a b c -> (a b) c', backend='auto').backend_for(big.shape, big.strides, 'float32') == 'numpy'
+    assert rr.compile('a b c -> (c a) b').backend_for(big.shape, big.strides, big.dtype) == 'numpy'
+
+
+@pytest.mark.parametrize("pattern, shape, axes", [
+    ('b c h w -> b h w c', (2, 3, 5, 7), {}),
+    ('b h w c -> b c h w', (2, 33, 65, 3), {}),
+    ('a b c d e -> e (d c b a)', (2, 3, 4, 5, 6), {}),
+    ('b (h w) c -> b c h w', (2, 12, 10), {'h': 3}),
+    ('... c -> c ...', (2, 3, 4), {}),
+    ('1 h 1 c -> c h', (1, 70, 1, 40), {}),
+    ('2 b c -> c b', (2, 3, 4), {}),
+    ('a b -> b a', (0, 3), {}),
+    ('a -> a', (5,), {}),
+])
+def test_numba_backend_matches_numpy(pattern, shape, axes):
+    pytest.importorskip("numba")
+    from rearrange import Rearrange
+    for dtype in (np.float64, np.int32, np.complex128, np.bool_):
+        x = (np.random.rand(*shape) * 10).astype(dtype)
+        result = Rearrange(use_numba=True)(x, pattern, **axes)
+        expected = rearrange(x, pattern, **axes)
+        assert result.shape == expected.shape
+        assert result.dtype == expected.dtype
+        assert np.array_equal(result, expected)
+
+def test_numba_backend_non_contiguous_input():
+    pytest.importorskip("numba")
+    from rearrange import Rearrange
+    x = np.random.rand(6, 8, 10)[:, ::2, 1:]
+    result = Rearrange(use_numba=True)(x, 'h w c -> c (w h)')
+    assert np.array_equal(result, x.transpose(2, 1, 0).reshape(9, 24))
+
+
+def test_coalesce_axes():
+    from rearrange.optimizer import coalesce_axes, classify
+    assert coalesce_axes((2, 3, 4, 5), (0, 3, 1, 2)) == ((2, 12, 5), (0, 2, 1))
+    assert coalesce_axes((2, 1, 3), (2, 1, 0)) == ((2, 3), (1, 0))
+    assert coalesce_axes((2, 3, 4), (0, 1, 2)) == ((24,), (0,))
+    assert coalesce_axes((1, 1), (1, 0)) == ((), ())
+    assert classify(coalesce_axes((2, 3, 4), (2, 0, 1))[1]) == 'transpose2d'
+    assert classify(coalesce_axes((2, 3, 4), (2, 1, 0))[1]) == 'general'
+
+def test_identity_after_coalescing_returns_view():
+    x = np.random.rand(2, 3, 1, 4)
+    result = rearrange(x, 'a b 1 c -> (a b) c')
+    assert result.shape == (6, 4)
+    assert np.shares_memory(result, x)
+
+@pytest.mark.parametrize("use", ["use_numba", "use_eigen"])
+def test_compiled_backends_high_rank_patterns(use):
+    if use == "use_numba":
+        pytest.importorskip("numba")
+    else:
+        pytest.importorskip("rearrange.eigen_backend")
+    from rearrange import Rearrange
+    x = np.random.rand(2, 3, 2, 2, 3, 2, 2, 3, 2, 2, 3, 2).astype(np.float32)
+    pattern = 'a b c d e f g h i j k l -> g h i j k l a b c d e f'
+    result = Rearrange(**{use: True})(x, pattern)
+    assert np.array_equal(result, x.reshape(144, 144).T.reshape(result.shape))
+    result = Rearrange(**{use: True})(x, 'a b c d e f g h i j k l -> l k j i h g f e d c b a')
+    assert np.array_equal(result, x.transpose(*range(11, -1, -1)))
+
+
+@pytest.mark.parametrize("dtype", [np.float16, np.float32, np.float64, np.complex64, np.complex128, np.bool_,
+                                   np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint64])
+def test_eigen_backend_dtypes(dtype):
+    pytest.importorskip("rearrange.eigen_backend")
+    from rearrange import Rearrange
+    x = (np.random.rand(4, 6, 5, 3) * 100).astype(dtype)
+    result = Rearrange(use_eigen=True)(x, 'b (h w) c d -> b d c w h', h=2)
+    assert result.dtype == x.dtype
+    assert np.array_equal(result, rearrange(x, 'b (h w) c d -> b d c w h', h=2))
+
+def test_eigen_backend_thread_pool_concurrent_calls():
+    eigen = pytest.importorskip("rearrange.eigen_backend")
+    import threading
+    from rearrange import Rearrange
+    previous = eigen.get_num_threads()
+    eigen.set_num_threads(3)
+    try:
+        x = np.random.rand(64, 32, 48)
+        expected = x.transpose(2, 0, 1)
+        r = Rearrange(use_eigen=True)
+        results = []
+        def worker():
+            results.append(all(np.array_equal(r(x, 'a b c -> c a b'), expected) for _ in range(10)))
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == [True] * 4
+    finally:
+        eigen.set_num_threads(previous)
+    with pytest.raises(ValueError):
+        eigen.set_num_threads(0)
+
+
+def test_auto_backend_matches_numpy():
+    from rearrange import Rearrange
+    r = Rearrange(backend='auto')
+    assert r.backend_name == 'auto'
+    for shape in [(2, 3, 4), (64, 128, 96)]:
+        x = np.random.rand(*shape).astype(np.float32)
+        assert np.array_equal(r(x, 'a b c -> c a b'), x.transpose(2, 0, 1))
+        assert np.array_equal(r(x[:, ::2], 'a b c -> c a b'), x[:, ::2].transpose(2, 0, 1))
+    assert np.array_equal(rearrange(x, 'a b c -> b (c a)', backend='auto'), x.transpose(1, 2, 0).reshape(128, -1))
+
+def test_auto_backend_cost_model(tmp_path):
+    import json
+    from rearrange import dispatch
+    from rearrange.core import Rearrange
+    recipe = Rearrange().plan('a b c -> c a b', (64, 128, 96), np.float32, {})
+    identity = Rearrange().plan('a b c -> (a b) c', (64, 128, 96), np.float32, {})
+    small = Rearrange().plan('a b c -> c a b', (2, 3, 4), np.float32, {})
+    profile = {'version': dispatch.PROFILE_VERSION, 'breakpoints': {
+        'transpose2d': [[0, ['numpy']], [1024, ['not-installed', 'numba', 'numpy']]],
+        'general': [[0, ['numpy']]], 'high_rank': [[0, ['numpy']]]}}
+    path = tmp_path / 'profile.json'
+    path.write_text(json.dumps(profile))
+    try:
+        dispatch.load_profile(str(path))
+        expected = 'numba' if dispatch.backend_available('numba') else 'numpy'
+        assert dispatch.select_backend(recipe, np.dtype(np.float32)) == expected
+        assert dispatch.select_backend(recipe, np.dtype(np.float32), view=True) == 'numpy'
+        assert dispatch.select_backend(recipe, np.dtype('U3')) == expected
+        assert dispatch.select_backend(recipe, np.dtype(object)) == 'numpy'
+        assert dispatch.select_backend(identity, np.dtype(np.float32)) == 'numpy'
+        assert dispatch.select_backend(small, np.dtype(np.float32)) == 'numpy'
+        assert dispatch.select_reduce_backend(1 << 30) == 'numpy'
+        profile['breakpoints']['reduce'] = [[0, ['numpy']], [1024, ['numba', 'numpy']]]
+        path.write_text(json.dumps(profile))
+        dispatch.load_profile(str(path))
+        assert dispatch.select_reduce_backend(512) == 'numpy'
+        assert dispatch.select_reduce_backend(4096) == expected
+    finally:
+        dispatch.load_profile(str(tmp_path / 'missing.json'))
+
+def test_autotune_writes_profile(tmp_path):
+    import json
+    from rearrange import dispatch
+    path = tmp_path / 'autotune.json'
+    try:
+        profile = dispatch.autotune(str(path), sizes=(1 << 14, 1 << 16), repeat=1)
+        assert json.loads(path.read_text())['breakpoints'] == profile['breakpoints']
+        assert 'reduce' in profile['breakpoints']
+        for breakpoints in profile['breakpoints'].values():
+            assert breakpoints[0][0] == 0
+            assert all(ranking[-1] == 'numpy' for _, ranking in breakpoints)
+        assert dispatch.current_profile() == profile
+    finally:
+        dispatch.load_profile(str(tmp_path / 'missing.json'))
+
+def test_unknown_backend():
+    from rearrange import Rearrange
+    with pytest.raises(ValueError, match="Unknown backend"):
+        Rearrange(backend='cuda')
+
+
+def test_benchmark_smoke(tmp_path):
+    import json
+    from rearrange import benchmark
+    report = benchmark.run(sizes=[100], backends=['numpy', 'auto'], min_time=1e-4, repeat=1)
+    records = report['results']
+    assert {r['family'] for r in records} == set(benchmark.FAMILIES)
+    assert {r['layout'] for r in records} == set(benchmark.LAYOUTS)
+    assert {r['backend'] for r in records} == {'raw_numpy', 'numpy', 'auto'}
+    assert all(r['latency_s'] > 0 and r['peak_bytes'] >= 0 for r in records)
+    assert any(r['view'] for r in records) and any(not r['view'] for r in records)
+    out = tmp_path / 'bench.json'
+    assert benchmark.main(['--sizes', '100', '--families', 'permute', '--backends', 'numpy',
+                           '--min-time', '0.0001', '--repeat', '1', '--out', str(out)]) == 0
+    saved = json.loads(out.read_text())
+    slower = {**saved, 'results': [{**r, 'latency_s': r['latency_s'] * 10} for r in saved['results']]}
+    assert len(benchmark.compare(saved, slower)) == len(saved['results'])
+    assert benchmark.compare(slower, saved) == []
+
+
+def test_instrumentation_records_calls():
+    import rearrange as rr
+    rr.instrument.reset()
+    x = np.random.rand(2, 3, 4)
+    with rr.instrument.recording() as calls:
+        rearrange(x, 'a b c -> (a b) c')
+        rearrange(x, 'a b c -> (c b) a')
+        rr.compile('a b c -> c b a')(x)
+    assert not rr.instrument.enabled
+    assert [c.pattern for c in calls] == ['a b c -> (a b) c', 'a b c -> (c b) a', 'a b c -> c b a']
+    view, copy, planned = calls
+    assert view.is_view and view.bytes_allocated == 0 and view.output_shape == (6, 4)
+    assert not copy.is_view and copy.bytes_allocated == x.nbytes
+    assert copy.input_shape == (2, 3, 4) and copy.backend == 'numpy'
+    assert planned.parse_s == 0.0 and planned.execute_s >= 0
+    stats = rr.instrument.stats()
+    assert stats['a b c -> (c b) a']['copies'] == 1
+    assert stats['a b c -> (a b) c']['views'] == 1
+    rearrange(x, 'a b c -> (a b) c')
+    assert rr.instrument.stats()['a b c -> (a b) c']['calls'] == 1
+
+def test_instrumentation_callbacks_and_prometheus():
+    import rearrange as rr
+    rr.instrument.reset()
+    seen = []
+    rr.instrument.add_callback(seen.append)
+    rr.instrument.enable()
+    try:
+        rearrange(np.zeros((4, 5)), 'h w -> w h', backend='auto')
+    finally:
+        rr.instrument.disable()
+        rr.instrument.remove_callback(seen.append)
+    assert len(seen) == 1 and seen[0].backend in ('numpy', 'numba', 'eigen')
+    text = rr.instrument.prometheus_text()
+    assert '# TYPE rearrange_calls_total counter' in text
+    assert 'rearrange_calls_total{pattern="h w -> w h"} 1' in text
+    assert 'rearrange_execute_seconds_total{pattern="h w -> w h"}' in text
+
+
+def test_instrumentation_records_every_execution_path():
+    import rearrange as rr
+    x = np.random.rand(1024, 1024)
+    out = np.empty((1024, 1024))
+    with rr.instrument.recording() as calls:
+        rearrange(x, 'a b -> b a', out=out)
+        rearrange(x, 'a b -> (a b)', copy=False)
+        rearrange(x, 'a b -> (b a)', workers=2)
+        rr.compile('a b -> b a')(x, out=out)
+        rr.reduce(x, 'a b -> a', 'sum')
+        rr.repeat(x[:2], 'a b -> a b c', c=3)
+        rr.batch([x[:2], x[:2]], 'a b -> (b a)')
+        rr.lazy(x[:4]).rearrange('a b -> b a').rearrange('b a -> (a b)').compute()
+        packed, shapes = rr.pack([x[:2], x[:3]], '* b')
+        rr.unpack(packed, shapes, '* b')
+    assert [c.pattern for c in calls] == ['a b -> b a', 'a b -> (a b)', 'a b -> (b a)', 'a b -> b a', 'a b -> a',
+                                          'a b -> a b c', 'a b -> (b a)', 'a b -> (b a)',
+                                          'a b -> b a | b a -> (a b)', '* b', '* b']
+    into, view, chunked, planned, reduced, repeated, first, second, chain, pack, unpack = calls
+    assert chain.input_shape == (4, 1024) and chain.output_shape == (4096,) and chain.is_view
+    assert pack.input_shape == ((2, 1024), (3, 1024)) and pack.output_shape == (5, 1024)
+    assert not pack.is_view and pack.bytes_allocated == packed.nbytes
+    assert unpack.output_shape == ((2, 1024), (3, 1024)) and unpack.is_view and unpack.bytes_allocated == 0
+    assert not into.is_view and into.bytes_allocated == 0 and planned.bytes_allocated == 0
+    assert view.is_view and view.output_shape == (1024 * 1024,)
+    assert not chunked.is_view and chunked.bytes_allocated == x.nbytes
+    assert reduced.output_shape == (1024,) and reduced.bytes_allocated == 1024 * 8
+    assert repeated.is_view and repeated.output_shape == (2, 1024, 3)
+    assert first.input_shape == second.input_shape == (2, 1024) and second.parse_s == 0.0
+
+
+def test_chunked_memmap_to_path(tmp_path):
+    import tracemalloc
+    src = np.lib.format.open_memmap(str(tmp_path / 'x.npy'), mode='w+', dtype=np.float32, shape=(16, 32, 24, 3))
+    src[:] = np.random.rand(*src.shape)
+    src.flush()
+    x = np.load(str(tmp_path / 'x.npy'), mmap_mode='r')
+    expected = np.ascontiguousarray(x.transpose(0, 3, 1, 2))
+    budget = 64 * 1024
+    tracemalloc.start()
+    try:
+        out = rearrange(x, 'b ... c -> b c ...', out=str(tmp_path / 'y.npy'), max_memory=budget)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert isinstance(out, np.memmap)
+    assert peak < budget
+    assert np.array_equal(np.load(str(tmp_path / 'y.npy')), expected)
+
+def test_chunked_into_existing_output():
+    x = np.random.rand(6, 20, 5)
+    out = np.empty((5, 6, 20))
+    result = rearrange(x, 'b (h w) c -> c b (h w)', h=4, out=out, max_memory=800)
+    assert result is out
+    assert np.array_equal(out, x.transpose(2, 0, 1))
+    assert np.array_equal(rearrange(x, 'a b c -> (c a) b', max_memory=1000), x.transpose(2, 0, 1).reshape(30, 20))
+
+def test_chunked_errors():
+    x = np.random.rand(4, 5)
+    with pytest.raises(ValueError, match="Output shape mismatch"):
+        rearrange(x, 'a b -> b a', out=np.empty((4, 5)))
+    with pytest.raises(ValueError, match="Output dtype mismatch"):
+        rearrange(x, 'a b -> b a', out=np.empty((5, 4), dtype=np.float32))
+    with pytest.raises(ValueError, match="too small"):
+        rearrange(x, 'a b -> (b a)', max_memory=16)
+
+
+def test_parallel_slabs_cover_output():
+    from rearrange.parallel import slabs
+    for shape, parts in [((8, 5), 4), ((2, 3, 7), 4), ((1, 1, 9), 3), ((3,), 8), ((), 2)]:
+        covered = np.zeros(shape, dtype=int)
+        for idx in slabs(shape, parts):
+            covered[idx] += 1
+        assert np.all(covered == 1)
+    assert len(slabs((2, 16, 4), 4)) == 4
+
+def test_parallel_workers_match_serial(monkeypatch):
+    import rearrange as rr
+    from rearrange import parallel
+    monkeypatch.setattr(parallel, 'PARALLEL_MIN_BYTES', 0)
+    x = np.random.rand(6, 10, 12, 3)
+    expected = x.transpose(0, 3, 1, 2).reshape(6, 30, 12)
+    result = rearrange(x, 'b h w c -> b (c h) w', workers=4)
+    assert result.flags.c_contiguous and np.array_equal(result, expected)
+    strided = np.asfortranarray(x)[:, ::2]
+    assert np.array_equal(rearrange(strided, 'b h w c -> (c w) b h', workers=3),
+                          strided.transpose(3, 2, 0, 1).reshape(36, 6, 5))
+    assert np.shares_memory(rearrange(x, 'b h w c -> (b h) w c', workers=4), x)
+    rr.set_workers(4)
+    try:
+        assert np.array_equal(rearrange(x, 'b h w c -> b (c h) w'), expected)
+    finally:
+        rr.set_workers(1)
+    with pytest.raises(ValueError, match="workers must be at least 1"):
+        rr.set_workers(0)
+
+def test_set_workers_sizes_eigen_pool():
+    import rearrange as rr
+    eigen = pytest.importorskip("rearrange.eigen_backend")
+    before = eigen.get_num_threads()
+    rr.set_workers(3)
+    try:
+        assert eigen.get_num_threads() == 3
+        x = np.arange(2 * 3 * 4).reshape(2, 3, 4)
+        assert np.array_equal(rr.rearrange(x, 'a b c -> c a b', backend='eigen'), x.transpose(2, 0, 1))
+    finally:
+        rr.set_workers(1)
+        eigen.set_num_threads(before)
+    assert rr.get_workers() == 1
+
+def test_parallel_pool_growth_keeps_old_pool_usable():
+    from rearrange import parallel
+    old = parallel._executor_for(2)
+    assert parallel.map_tasks(64, lambda k: k * k, range(5)) == [0, 1, 4, 9, 16]
+    assert parallel._executor_for(2) is not old
+    assert old.submit(lambda: 7).result() == 7
+
+
+@pytest.mark.parametrize("backend", ['numpy', 'numba', 'eigen', 'auto'])
+def test_out_written_by_every_backend(backend):
+    import rearrange as rr
+    x = np.random.rand(8, 6, 5).astype(np.float32)
+    out = np.empty((40, 6), dtype=np.float32)
+    assert rearrange(x, 'a b c -> (c a) b', backend=backend, out=out) is out
+    assert np.array_equal(out, x.transpose(2, 0, 1).reshape(40, 6))
+    plan = rr.compile('a b c -> (c a) b', backend=backend)
+    out[...] = 0
+    assert plan(x, out=out) is out and np.array_equal(out, x.transpose(2, 0, 1).reshape(40, 6))
+
+def test_buffer_pool_reuses_buffers():
+    from rearrange import BufferPool
+    pool = BufferPool(max_bytes=1000)
+    x = np.random.rand(4, 5)
+    y = rearrange(x, 'a b -> (b a)', pool=pool)
+    assert np.array_equal(y, x.T.ravel()) and pool.info().leased == 1
+    assert pool.release(y) and not pool.release(y)
+    assert rearrange(x + 1, 'a b -> (b a)', pool=pool) is y
+    assert pool.info().hits == 1
+    view = rearrange(x, 'a b -> (a b)', pool=pool)
+    assert np.shares_memory(view, x) and not pool.release(view)
+    with pool.leased((100, 2), np.float64) as big:
+        assert big.shape == (100, 2)
+    assert pool.info().idle == 0
+    with pool.leased((5, 4), np.float32):
+        pass
+    assert pool.info().idle == 1 and pool.info().idle_bytes == 80
+    pool.clear()
+    assert pool.info().idle_bytes == 0
+
+
+@pytest.mark.parametrize("backend", ['numpy', 'numba', 'eigen'])
+def test_copy_false_returns_views(backend):
+    x = np.random.rand(4, 5, 6)
+    for pattern in ['a b c -> c (a b)', '(g a) b c -> g (a b) c', '... c -> c ...', 'a 1 c -> (a c)']:
+        tensor = x[:, :1].copy() if '1' in pattern else x
+        view = rearrange(tensor, pattern, backend=backend, copy=False, g=2)
+        assert np.shares_memory(view, tensor)
+        assert np.array_equal(view, rearrange(tensor, pattern, g=2))
+        copied = rearrange(tensor, pattern, backend=backend, copy=True, g=2)
+        assert not np.shares_memory(copied, tensor) and np.array_equal(copied, view)
+
+def test_copy_false_names_offending_group():
+    import rearrange as rr
+    x = np.random.rand(4, 5, 6)
+    with pytest.raises(ValueError, match=r"output group \(a c\) merges axes"):
+        rearrange(x, 'a b c -> b (a c)', copy=False)
+    with pytest.raises(ValueError, match=r"output group \(b c\)"):
+        rr.compile('a b c -> a (b c)')(np.asfortranarray(x), copy=False)
+    with pytest.raises(ValueError, match="cannot be combined"):
+        rearrange(x, 'a b c -> c b a', copy=False, out=np.empty((6, 5, 4)))
+
+
+@pytest.mark.parametrize("backend", ['numpy', 'numba', 'auto'])
+@pytest.mark.parametrize("reduction", ['sum', 'mean', 'max', 'min', 'prod'])
+def test_reduce_pooling(backend, reduction):
+    from rearrange import reduce
+    x = np.random.rand(2, 8, 6, 3).astype(np.float32)
+    expected = getattr(np, reduction)(x.reshape(2, 4, 2, 3, 2, 3), axis=(2, 4))
+    result = reduce(x, 'b (h h2) (w w2) c -> b h w c', reduction, backend=backend, h2=2, w2=2)
+    assert result.shape == expected.shape and result.dtype == expected.dtype
+    assert np.allclose(result, expected)
+    ints = np.arange(24, dtype=np.int32).reshape(2, 3, 4)
+    expected = getattr(np, reduction)(ints, axis=1).T
+    result = reduce(ints, 'a b c -> c a', reduction, backend=backend)
+    assert result.dtype == expected.dtype and np.array_equal(result, expected)
+
+def test_reduce_numba_layouts_and_accuracy(tmp_path):
+    from rearrange import dispatch, reduce
+    from rearrange.core import Rearrange
+    compiled = Rearrange(backend='numba')
+    x = np.random.default_rng(0).random((256, 96)).astype(np.float32)
+    for pattern, axes in [('a b -> b', {}), ('a b -> a', {}), ('(a p) b -> a b', {'p': 4}),
+                          ('a (b q) -> b a', {'q': 3}), ('a b -> ', {})]:
+        for reduction in ('sum', 'mean', 'max', 'min', 'prod'):
+            expected = reduce(x, pattern, reduction, **axes)
+            result = compiled.reduce(x, pattern, reduction, **axes)
+            assert result.dtype == expected.dtype and np.allclose(result, expected, rtol=1e-5)
+        assert np.array_equal(compiled.reduce(x[::-1, ::2], pattern, 'max', **axes),
+                              reduce(x[::-1, ::2], pattern, 'max', **axes))
+    ones = np.full((1 << 20, 2), 0.1, dtype=np.float32)
+    exact = ones[:, 0].astype(np.float64).sum()
+    assert abs(compiled.reduce(ones, 'a b -> b', 'sum')[0] - exact) <= abs(ones.sum(axis=0)[0] - exact)
+    # without a measured crossover, auto stays on NumPy
+    dispatch.load_profile(str(tmp_path / 'missing.json'))
+    auto = Rearrange(backend='auto')
+    assert auto._reduce_backend(ones, auto.plan_reduce('a b -> b', ones.shape, ones.dtype, {})) == 'numpy'
+
+def test_reduce_literals_and_errors():
+    from rearrange import reduce
+    x = np.random.rand(4, 3)
+    assert np.allclose(reduce(x, 'a 3 -> a', 'max'), x.max(axis=1))
+    assert np.allclose(reduce(x, 'a b -> ', 'sum'), x.sum())
+    assert np.allclose(reduce(x, 'a b -> b a', 'mean'), x.T)
+    with pytest.raises(ValueError, match="Unknown reduction"):
+        reduce(x, 'a b -> a', 'median')
+    with pytest.raises(ValueError, match="Output axis"):
+        reduce(x, 'a b -> a c', 'sum')
+
+
+def test_repeat_returns_broadcast_views():
+    from rearrange import repeat
+    x = np.random.rand(3, 4)
+    for pattern, expected in [('h w -> h w c', np.broadcast_to(x[:, :, None], (3, 4, 5))),
+                              ('h w -> c (h w)', np.broadcast_to(x.reshape(1, 12), (5, 12))),
+                              ('h w -> w c h', np.broadcast_to(x.T[:, None], (4, 5, 3))),
+                              ('... w -> ... c w', np.broadcast_to(x[:, None], (3, 5, 4)))]:
+        result = repeat(x, pattern, c=5)
+        assert np.shares_memory(result, x) and not result.flags.writeable
+        assert np.array_equal(result, expected)
+    mask = repeat(np.ones((1000, 1000), dtype=np.float32), 'h w -> h w c', c=1024)
+    assert mask.shape == (1000, 1000, 1024) and mask.strides[-1] == 0
+    assert repeat(x, 'h w -> h w 3').shape == (3, 4, 3)
+
+def test_repeat_materializes_merged_groups():
+    from rearrange import repeat
+    x = np.random.rand(3, 4)
+    result = repeat(x, 'h w -> (h c) w', c=2)
+    assert result.flags.writeable and not np.shares_memory(result, x)
+    assert np.array_equal(result, np.repeat(x, 2, axis=0))
+    assert np.array_equal(repeat(x, 'h w -> (c h) w', c=2), np.tile(x, (2, 1)))
+    assert np.array_equal(repeat(x, 'h w -> h (w c)', c=3, workers=2), np.repeat(x, 3, axis=1))
+    copied = repeat(x, 'h w -> h w c', c=2, copy=True)
+    assert copied.flags.writeable and np.array_equal(copied, np.stack([x, x], axis=-1))
+    with pytest.raises(ValueError, match=r"output group \(h c\)"):
+        repeat(x, 'h w -> (h c) w', c=2, copy=False)
+    with pytest.raises(ValueError, match="Output axis 'c' not in input"):
+        repeat(x, 'h w -> h w c')
+
+
+def test_lazy_chain_folds_into_one_transpose():
+    import rearrange as rr
+    x = np.random.rand(2, 12, 8, 3)
+    steps = [('b (h p) (w q) c -> b h w p q c', {'p': 4, 'q': 2}),
+             ('b h w p q c -> b h w c p q', {}),
+             ('b h w c p q -> (b h w) (c p q)', {}),
+             ('n d -> d n', {})]
+    chain = rr.lazy(x)
+    expected = x
+    for pattern, axes in steps:
+        chain = chain.rearrange(pattern, **axes)
+        expected = rearrange(expected, pattern, **axes)
+    assert chain.shape == expected.shape
+    assert len(chain.segments()) == 1
+    assert np.array_equal(chain.compute(), expected)
+    assert np.array_equal(np.asarray(chain), expected)
+
+def test_lazy_chain_literals_and_validation():
+    import rearrange as rr
+    x = np.random.rand(2, 3, 1, 4)
+    chain = rr.lazy(x).rearrange('a 3 1 b -> b a').rearrange('b a -> (a b) 1')
+    assert np.array_equal(chain.compute(), x[:, 0, 0, :].reshape(8, 1))
+    merged = rr.lazy(np.random.rand(2, 3, 4)).rearrange('a b c -> (a b) c').rearrange('(b a) c -> a c b', a=2)
+    assert np.array_equal(merged.compute(), merged.tensor.reshape(3, 2, 4).transpose(1, 2, 0))
+    with pytest.raises(ValueError):
+        rr.lazy(x).rearrange('a b c d -> d c b a').rearrange('a b -> b a')
+
+
+def test_import_does_not_load_backends():
+    import os, subprocess, sys
+    code = "import sys, rearrange; assert 'numba' not in sys.modules and 'rearrange.eigen_backend' not in sys.modules"
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+def test_warmup_precompiles_and_plans():
+    import rearrange as rr
+    numba = pytest.importorskip("numba")
+    rr.clear_cache()
+    rr.warmup(['a b -> b a', ('a b c -> (c a) b', (2, 3, 4))], dtypes=[np.int16], backend='numba')
+    from rearrange.numba_backend import transpose_kernel
+    assert any(sig[0].dtype == numba.uint16 for sig in transpose_kernel.signatures)
+    assert rr.cache_info().currsize >= 1
+    with pytest.raises(ValueError, match="Pattern parsing error"):
+        rr.warmup(['a b -> (a b'])
+
+
+@pytest.mark.parametrize("backend", ['numba', 'eigen'])
+def test_compiled_backends_read_strided_inputs(backend):
+    import tracemalloc
+    if backend == 'eigen':
+        pytest.importorskip("rearrange.eigen_backend")
+    x = np.random.rand(6, 8, 10)
+    for view in [x[:, ::2], np.asfortranarray(x), x[::-1, :, ::-3], x.transpose(2, 0, 1),
+                 (x * 100).astype(np.int8)[::2, ::-1], x.astype(np.complex64)[:, 1::3]]:
+        for pattern in ['a b c -> c a b', 'a b c -> (c a) b', 'a b c -> b (a c)']:
+            expected = view.transpose(*{'a b c -> c a b': (2, 0, 1), 'a b c -> (c a) b': (2, 0, 1),
+                                        'a b c -> b (a c)': (1, 0, 2)}[pattern]).copy()
+            result = rearrange(view, pattern, backend=backend)
+            assert np.array_equal(result, expected.reshape(result.shape))
+    sliced = np.random.rand(64, 64, 64).astype(np.float32)[:, ::2]
+    rearrange(sliced, 'a b c -> c (b a)', backend=backend)
+    tracemalloc.start()
+    try:
+        rearrange(sliced, 'a b c -> c (b a)', backend=backend)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 1.5 * sliced.nbytes
+
+
+@pytest.mark.parametrize("backend", ['numba', 'eigen'])
+def test_compiled_backends_move_any_dtype(backend):
+    if backend == 'eigen':
+        pytest.importorskip("rearrange.eigen_backend")
+    else:
+        pytest.importorskip("numba")
+    x = np.random.rand(4, 6, 10) * 100
+    record = np.dtype([('a', np.uint8), ('b', np.float64)])
+    arrays = [x.astype(np.float16), x > 50, x.astype(np.complex128) * 1j, x.astype(np.int64),
+              x.astype('U3'), x.astype('S3'), x.astype('datetime64[s]'), x.astype(np.clongdouble)]
+    packed = np.zeros(x.shape, dtype=record)
+    packed['a'], packed['b'] = x, -x
+    arrays += [packed, packed.view('V9')]
+    for array in arrays:
+        for view in [array, array[:, ::-2], np.asfortranarray(array)]:
+            for pattern in ['a b c -> c a b', 'a b c -> (c a) b', 'a b c -> b (a c)', 'a b c -> a c b']:
+                result = rearrange(view, pattern, backend=backend)
+                expected = rearrange(view, pattern)
+                assert result.dtype == view.dtype
+                assert np.array_equal(result.view(np.uint8), np.ascontiguousarray(expected).view(np.uint8))
+        out = np.empty((10, 4 * 6), dtype=array.dtype)
+        assert rearrange(array, 'a b c -> c (a b)', backend=backend, out=out) is out
+        expected = np.ascontiguousarray(rearrange(array, 'a b c -> c (a b)'))
+        assert np.array_equal(out.view(np.uint8), expected.view(np.uint8))
+    objects = np.arange(6).astype(object).reshape(2, 3)
+    assert rearrange(objects, 'a b -> b a', backend=backend).tolist() == objects.T.tolist()
+
+
+@pytest.mark.parametrize("compiled", [True, False])
+def test_inplace_permutes_within_the_input_buffer(compiled, monkeypatch):
+    import rearrange as rr
+    from rearrange import core
+    if compiled:
+        pytest.importorskip("numba")
+    else:
+        monkeypatch.setattr(core, 'numba_available', False)
+    x = np.random.rand(2, 3, 4, 5)
+    cases = [('a b c d -> d b a c', {}), ('a b c d -> (c a) (d b)', {}), ('a b c d -> b a c d', {}),
+             ('a b (c e) d -> e d b a c', {'e': 2}), ('a b c d -> (a b c d)', {})]
+    for pattern, axes in cases:
+        for dtype in (np.float32, np.complex128, 'U2', object):
+            expected = rearrange(x.astype(dtype), pattern, **axes)
+            y = x.astype(dtype)
+            result = rearrange(y, pattern, inplace=True, **axes)
+            assert np.shares_memory(result, y) and result.flags.c_contiguous
+            assert result.dtype == y.dtype and np.array_equal(result, expected)
+    plan = rr.compile('a b -> b a')
+    y = np.arange(12.).reshape(3, 4)
+    assert np.array_equal(plan(y, inplace=True), np.arange(12.).reshape(3, 4).T)
+
+def test_inplace_rejects_inputs_it_cannot_reuse():
+    x = np.random.rand(4, 6)
+    with pytest.raises(ValueError, match="not C-contiguous"):
+        rearrange(x[:, ::2], 'a b -> b a', inplace=True)
+    with pytest.raises(ValueError, match="not C-contiguous"):
+        rearrange(x.T, 'a b -> b a', inplace=True)
+    readonly = x.copy()
+    readonly.flags.writeable = False
+    with pytest.raises(ValueError, match="read-only"):
+        rearrange(readonly, 'a b -> b a', inplace=True)
+    with pytest.raises(ValueError, match="cannot be combined"):
+        rearrange(x, 'a b -> b a', inplace=True, out=np.empty((6, 4)))
+    with pytest.raises(ValueError):
+        rearrange(x, 'a b -> b a c', inplace=True)
+
+
+def test_inplace_rejects_patterns_that_are_not_permutations():
+    import rearrange as rr
+    x = np.arange(24.).reshape(2, 3, 4)
+    with pytest.raises(ValueError, match="drops input elements"):
+        rearrange(x, '2 b c -> c b', inplace=True)
+    with pytest.raises(ValueError, match="drops input elements"):
+        rr.compile('2 b c -> c b')(x, inplace=True)
+    y = np.arange(6.).reshape(2, 3)
+    with pytest.raises(ValueError, match=r"output axes \('c',\) are not in the input"):
+        rearrange(y, 'a b -> a b c', c=2, inplace=True)
+    with pytest.raises(ValueError, match="not in the input"):
+        rr.compile('a b -> a b c', c=2)(y, inplace=True)
+    assert np.array_equal(x, np.arange(24.).reshape(2, 3, 4))
+    assert np.array_equal(y, np.arange(6.).reshape(2, 3))
+
+
+def test_infer_matches_the_planner_for_every_row():
+    import rearrange as rr
+    from rearrange.core import Rearrange
+    planner = Rearrange()
+    shapes = np.random.default_rng(0).integers(0, 5, size=(200, 3))
+    for pattern, axes in [('a b c -> c a b', {}), ('a b c -> (c a) b', {}), ('a (b c) d -> (d c) (a b)', {'b': 2}),
+                          ('a 2 b -> b a', {}), ('a b 1 -> (b a)', {}), ('... a -> a ...', {})]:
+        result = rr.infer(pattern, shapes, np.float32, **axes)
+        for shape, final, nbytes, view, error in zip(shapes, *result):
+            shape = tuple(int(s) for s in shape)
+            try:
+                recipe = planner.plan(pattern, shape, None, axes)
+            except ValueError:
+                assert error != 0 and nbytes == -1 and not view
+                continue
+            x = np.zeros(shape, dtype=np.float32)
+            assert error == 0 and tuple(final) == recipe.final_shape
+            assert nbytes == rearrange(x, pattern, **axes).nbytes
+            assert view == np.shares_memory(rearrange(x, pattern, **axes), x) or x.size == 0
+
+def test_infer_single_shape_and_error_codes():
+    import rearrange as rr
+    from rearrange.inference import ERRORS, GROUP_NOT_DIVISIBLE, LITERAL_MISMATCH
+    assert rr.infer('a (b c) -> c a b', (4, 6), c=2) == rr.Inference((2, 4, 3), 24 * 8, True, 0)
+    assert rr.infer('a b -> (b a)', [3, 5], 'uint8') == ((15,), 15, False, 0)
+    result = rr.infer('a (b c) 3 -> c a b 3', [[4, 6, 3], [4, 7, 3], [4, 6, 2]], c=2)
+    assert result.error.tolist() == [0, GROUP_NOT_DIVISIBLE, LITERAL_MISMATCH]
+    assert [ERRORS[e] for e in result.error] == ['ok', 'group_not_divisible', 'literal_mismatch']
+    assert result.shape.tolist() == [[2, 4, 3, 3], [-1] * 4, [-1] * 4]
+    with pytest.raises(ValueError, match="Mismatch between consumed axes"):
+        rr.infer('a b -> b a', (2, 3, 4))
+    with pytest.raises(ValueError, match="Too many unspecified axes"):
+        rr.infer('(a b) c -> a b c', np.ones((5, 2), dtype=int))
+    with pytest.raises(ValueError, match="Pattern parsing error"):
+        rr.infer('a b', (2, 3))
+
+
+def test_array_api_inputs_use_their_own_namespace():
+    import rearrange as rr
+    from types import SimpleNamespace
+    calls = []
+
+    class Wrapped:
+        def __init__(self, data):
+            self.data = data
+            self.shape = data.shape
+
+        def __array_namespace__(self, api_version=None):
+            return namespace
+
+        def __array__(self, dtype=None, copy=None):
+            raise AssertionError("converted to NumPy")
+
+        def __getitem__(self, index):
+            return Wrapped(self.data[index])
+
+    def reshape(x, shape):
+        calls.append('reshape')
+        return Wrapped(x.data.reshape(shape))
+
+    def permute_dims(x, axes):
+        calls.append('permute_dims')
+        return Wrapped(x.data.transpose(axes))
+
+    namespace = SimpleNamespace(reshape=reshape, permute_dims=permute_dims)
+    x = np.random.rand(2, 1, 3, 4)
+    for backend in ('numpy', 'numba', 'auto'):
+        result = rr.rearrange(Wrapped(x), 'a 1 b c -> c (a b)', backend=backend)
+        assert isinstance(result, Wrapped) and np.array_equal(result.data, rearrange(x, 'a 1 b c -> c (a b)'))
+    assert 'permute_dims' in calls
+    assert np.array_equal(rr.compile('a b c d -> d c b a')(Wrapped(x)).data, x.transpose(3, 2, 1, 0))
+    with pytest.raises(ValueError, match="need a NumPy array"):
+        rr.rearrange(Wrapped(x), 'a b c d -> d c b a', out=np.empty((4, 3, 1, 2)))
+
+def test_torch_tensors_stay_views():
+    torch = pytest.importorskip("torch")
+    x = torch.randn(2, 3, 4, requires_grad=True)
+    result = rearrange(x, 'a b c -> c (a b)')
+    assert isinstance(result, torch.Tensor) and result.grad_fn is not None
+    assert torch.equal(result, x.permute(2, 0, 1).reshape(4, 6))
+    view = rearrange(x.detach(), 'a b c -> b a c')
+    assert view.data_ptr() == x.data_ptr()
+
+def test_jax_arrays_use_jax_numpy():
+    jnp = pytest.importorskip("jax.numpy")
+    x = jnp.arange(24.).reshape(2, 3, 4)
+    result = rearrange(x, 'a b c -> c (a b)')
+    assert type(result) is type(x)
+    assert np.array_equal(np.asarray(result), np.arange(24.).reshape(2, 3, 4).transpose(2, 0, 1).reshape(4, 6))
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_pack_writes_into_one_buffer_and_unpack_returns_views(workers, monkeypatch):
+    import rearrange as rr
+    from rearrange import parallel
+    arrays = [np.random.rand(2, 4, 5, 3), np.random.rand(2, 6, 3)[:, ::2], np.random.rand(2, 3).astype(np.float32),
+              np.asfortranarray(np.random.rand(2, 2, 2, 2, 3))]
+    monkeypatch.setattr(parallel, 'PARALLEL_MIN_BYTES', 0)
+    packed, shapes = rr.pack(arrays, 'b * c', workers=workers)
+    assert packed.dtype == np.float64 and shapes == [(4, 5), (3,), (), (2, 2, 2)]
+    assert np.array_equal(packed, np.concatenate([a.reshape(2, -1, 3) for a in arrays], axis=1))
+    for part, array in zip(rr.unpack(packed, shapes, 'b * c'), arrays):
+        assert np.shares_memory(part, packed) and np.array_equal(part, array)
+    assert [p.shape for p in rr.unpack(packed, [(4, 5), (-1,), (), (2, 2, 2)], 'b * c')][1] == (2, 3, 3)
+    first, rest = rr.unpack(np.arange(12).reshape(3, 4), [(1,), (-1,)], '* c')
+    assert first.tolist() == [[0, 1, 2, 3]] and rest.shape == (2, 4)
+
+def test_pack_errors():
+    import rearrange as rr
+    with pytest.raises(ValueError, match="exactly one"):
+        rr.pack([np.ones((2, 3))], 'b c')
+    with pytest.raises(ValueError, match="only contain axis names"):
+        rr.pack([np.ones((2, 3))], 'b * (c d)')
+    with pytest.raises(ValueError, match="named axes"):
+        rr.pack([np.ones((2, 3)), np.ones((3, 3))], 'b * c')
+    with pytest.raises(ValueError, match="fewer than"):
+        rr.pack([np.ones(3)], 'b * c')
+    with pytest.raises(ValueError, match="hold 5 elements"):
+        rr.unpack(np.ones((2, 6)), [(2,), (3,)], 'b *')
+    with pytest.raises(ValueError, match="Cannot infer"):
+        rr.unpack(np.ones((2, 7)), [(2,), (-1, 2)], 'b *')
+
+
+def test_batch_buckets_by_shape_and_keeps_input_order():
+    import rearrange as rr
+    rng = np.random.default_rng(0)
+    arrays = [rng.random((3, 4, 5)), rng.random((3, 2, 5)), rng.random((3, 4, 5)).astype(np.float32),
+              rng.random((3, 4, 5)), rng.random((3, 2, 5))]
+    for stack in (None, True, False):
+        result = rr.batch(arrays, 'c h w -> (w h) c', stack=stack)
+        assert len(result.outputs) == len(arrays)
+        for output, array in zip(result.outputs, arrays):
+            assert output.dtype == array.dtype
+            assert np.array_equal(output, rearrange(array, 'c h w -> (w h) c'))
+        assert [(b.shape, b.dtype, b.count) for b in result.buckets] == [
+            ((3, 4, 5), np.float64, 2), ((3, 2, 5), np.float64, 2), ((3, 4, 5), np.float32, 1)]
+        assert all(b.stacked == (stack is not False and b.count > 1) for b in result.buckets)
+        assert all(b.plan_s >= 0 and b.execute_s >= 0 for b in result.buckets)
+    views = rr.batch([arrays[0], arrays[3]], 'c h w -> (c h) w')
+    assert not views.buckets[0].stacked and np.shares_memory(views.outputs[0], arrays[0])
+    strided = [arrays[0][:, ::2], arrays[3][:, ::2]]
+    stacked = rr.batch(strided, 'c h w -> (w h) c', stack=True)
+    assert stacked.buckets[0].stacked and stacked.outputs[0].base is stacked.outputs[1].base is not None
+    assert not any(np.shares_memory(output, array) for output, array in zip(stacked.outputs, strided))
+    assert all(np.array_equal(o, rearrange(a, 'c h w -> (w h) c')) for o, a in zip(stacked.outputs, strided))
+    assert rr.batch([], 'a b -> b a') == ([], [])
+    with pytest.raises(ValueError, match="Pattern parsing error"):
+        rr.batch(arrays, 'c h w')
+
+
 if __name__ == "__main__":
     pytest.main(["-v", __file__])